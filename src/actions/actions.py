@@ -0,0 +1,150 @@
+#!/usr/local/sbin/charm-env python3
+#
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import sys
+
+# Load modules from $CHARM_DIR/lib
+_path = os.path.dirname(os.path.realpath(__file__))
+_lib = os.path.abspath(os.path.join(_path, '../lib'))
+_reactive = os.path.abspath(os.path.join(_path, '../reactive'))
+
+
+def _add_path(path):
+    if path not in sys.path:
+        sys.path.insert(1, path)
+
+
+_add_path(_lib)
+_add_path(_reactive)
+
+import charmhelpers.contrib.openstack.utils as os_utils  # noqa: E402
+import charmhelpers.core.hookenv as hookenv  # noqa: E402
+import charms.reactive.relations as relations  # noqa: E402
+import charms_openstack.bus  # noqa: E402
+import charms_openstack.charm  # noqa: E402
+
+charms_openstack.bus.discover()
+
+# The interfaces that the configs are rendered with; see render_stuff() in
+# the reactive handlers.
+UPGRADE_INTERFACE_FLAGS = ('shared-db.available',
+                           'identity-service.available',
+                           'amqp.available')
+
+
+def db_sync(*args):
+    """Force a database sync on the leader."""
+    if not hookenv.is_leader():
+        hookenv.action_fail("db-sync must be run on the leader unit")
+        return
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        manila_charm.db_sync(force=True)
+        hookenv.action_set({'marker': manila_charm.db_sync_marker()})
+
+
+def openstack_upgrade(*args):
+    """Upgrade OpenStack and report the time taken by each phase."""
+    if not hookenv.config('action-managed-upgrade'):
+        hookenv.action_fail("action-managed-upgrade must be set to use this "
+                            "action")
+        return
+    interfaces = [relations.endpoint_from_flag(flag)
+                  for flag in UPGRADE_INTERFACE_FLAGS]
+    if None in interfaces:
+        hookenv.action_fail("The shared-db, identity-service and amqp "
+                            "relations must be available")
+        return
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        if not manila_charm.openstack_upgrade_available(
+                manila_charm.release_pkg):
+            hookenv.action_set({'outcome': 'no upgrade available'})
+            return
+        timings = manila_charm.run_upgrade(interfaces_list=interfaces)
+    result = {'outcome': 'success'}
+    result.update({'timings.{}'.format(phase): '{:.2f}'.format(seconds)
+                   for phase, seconds in timings.items()})
+    hookenv.action_set(result)
+
+
+def purge_deleted_rows(*args):
+    """Purge soft-deleted rows from the manila database on the leader."""
+    if not hookenv.is_leader():
+        hookenv.action_fail("purge-deleted-rows must be run on the leader "
+                            "unit")
+        return
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        age = hookenv.action_get('age')
+        if age is None:
+            age = manila_charm.options.purge_deleted_rows_age
+        if hookenv.action_get('dry-run'):
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=age)
+            hookenv.action_set({
+                'command': ' '.join(manila_charm.purge_cmd + [str(age)]),
+                'cutoff': cutoff.isoformat(),
+            })
+            return
+        rows, elapsed = manila_charm.purge_deleted_rows(age)
+        hookenv.action_set({
+            # manila-manage only logs the rows it removes.
+            'rows-removed': rows if rows is not None else 'unknown',
+            'elapsed-seconds': '{:.2f}'.format(elapsed),
+        })
+
+
+def restart_pending_services(*args):
+    """Run the queued service restarts and reloads."""
+    if os_utils.is_unit_paused_set():
+        hookenv.action_fail("Unit is paused; resume it first")
+        return
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        done = manila_charm.run_pending_restarts()
+    hookenv.action_set({
+        'services': ' '.join('{}:{}'.format(service, action)
+                             for service, action in done)})
+
+
+# Actions to function mapping, to allow for illegal python action names that
+# can map to a python function.
+ACTIONS = {
+    'db-sync': db_sync,
+    'openstack-upgrade': openstack_upgrade,
+    'purge-deleted-rows': purge_deleted_rows,
+    'restart-pending-services': restart_pending_services,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return "Action {} undefined".format(action_name)
+    else:
+        try:
+            action(args)
+        except Exception as e:
+            hookenv.action_fail(str(e))
+        else:
+            # The charm defers assessing the status and running the queued
+            # restarts to the end of the hook; charms.reactive runs those
+            # callbacks after a hook, but nothing does after an action.
+            hookenv._run_atexit()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus exporter for the manila services on this unit.
+
+Serves, in the Prometheus text format:
+
+ * request counts and a latency histogram from the manila access log (the
+   log format must end with the request duration in microseconds, %D);
+ * response bytes before and after gzip compression, from the optional
+   compression log ('<input bytes> <output bytes>' per request);
+ * memory and CPU usage of each service, from its systemd cgroup;
+ * the number of manila-api WSGI daemon processes;
+ * the duration of the last charm hook and the number of unchanged plugin
+   auth writes skipped, as recorded by the charm.
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import os
+import re
+import socket
+import socketserver
+import sys
+import threading
+
+# '... [<time>] "<request>" <status> <bytes> ... <usecs>'
+ACCESS_LOG_RE = re.compile(
+    r'^\S+ \S+ \S+ \[[^\]]+\] "[^"]*" (?P<status>\d{3}) .* (?P<duration>\d+)$')
+# '<input bytes> <output bytes>', or '- -' for an uncompressed response.
+COMPRESSION_LOG_RE = re.compile(r'^(?P<input>\d+) (?P<output>\d+)$')
+# latency histogram buckets, in seconds.
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+WSGI_PROCESS_PREFIX = b'(wsgi:manila-api'
+
+
+class AccessLogStats(object):
+    """Follow an access log and accumulate request counts and latencies."""
+
+    def __init__(self, path, from_start=False):
+        self.path = path
+        self.inode = None
+        self.offset = None if not from_start else 0
+        self.partial = b''
+        self.requests = collections.Counter()
+        self.buckets = [0] * len(BUCKETS)
+        self.duration_sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def update(self):
+        """Read and account for any lines added since the last update."""
+        with self.lock:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return
+            if self.offset is None:
+                # start at the end of the existing log.
+                self.inode, self.offset = st.st_ino, st.st_size
+                return
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                # rotated or truncated.
+                self.inode, self.offset, self.partial = st.st_ino, 0, b''
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+                self.offset = f.tell()
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self._account(line.decode('utf-8', 'replace').strip())
+
+    def _account(self, line):
+        match = ACCESS_LOG_RE.match(line)
+        if not match:
+            return
+        self.requests[match.group('status')] += 1
+        duration = int(match.group('duration')) / 1000000.0
+        for i, le in enumerate(BUCKETS):
+            if duration <= le:
+                self.buckets[i] += 1
+        self.duration_sum += duration
+        self.count += 1
+
+    def metrics(self):
+        self.update()
+        with self.lock:
+            lines = [
+                '# HELP manila_api_requests_total manila API requests, by '
+                'HTTP status.',
+                '# TYPE manila_api_requests_total counter',
+            ]
+            for status in sorted(self.requests):
+                lines.append('manila_api_requests_total{{code="{}"}} {}'
+                             .format(status, self.requests[status]))
+            lines += [
+                '# HELP manila_api_request_duration_seconds manila API '
+                'request latency.',
+                '# TYPE manila_api_request_duration_seconds histogram',
+            ]
+            for le, count in zip(BUCKETS, self.buckets):
+                lines.append('manila_api_request_duration_seconds_bucket'
+                             '{{le="{}"}} {}'.format(le, count))
+            lines += [
+                'manila_api_request_duration_seconds_bucket{{le="+Inf"}} {}'
+                .format(self.count),
+                'manila_api_request_duration_seconds_sum {}'
+                .format(self.duration_sum),
+                'manila_api_request_duration_seconds_count {}'
+                .format(self.count),
+            ]
+        return lines
+
+
+class CompressionLogStats(AccessLogStats):
+    """Follow the compression log and accumulate the bytes saved."""
+
+    def __init__(self, path, from_start=False):
+        super().__init__(path, from_start=from_start)
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def _account(self, line):
+        match = COMPRESSION_LOG_RE.match(line)
+        if not match:
+            return
+        self.input_bytes += int(match.group('input'))
+        self.output_bytes += int(match.group('output'))
+        self.count += 1
+
+    def metrics(self):
+        self.update()
+        with self.lock:
+            return [
+                '# HELP manila_api_compressed_responses_total manila API '
+                'responses that were compressed.',
+                '# TYPE manila_api_compressed_responses_total counter',
+                'manila_api_compressed_responses_total {}'.format(self.count),
+                '# HELP manila_api_compression_input_bytes_total Bytes of '
+                'manila API responses before compression.',
+                '# TYPE manila_api_compression_input_bytes_total counter',
+                'manila_api_compression_input_bytes_total {}'
+                .format(self.input_bytes),
+                '# HELP manila_api_compression_output_bytes_total Bytes of '
+                'manila API responses after compression.',
+                '# TYPE manila_api_compression_output_bytes_total counter',
+                'manila_api_compression_output_bytes_total {}'
+                .format(self.output_bytes),
+            ]
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def service_metrics(services, cgroup_root='/sys/fs/cgroup/system.slice'):
+    """Return the memory and CPU usage of each service from its cgroup."""
+    memory = []
+    cpu = []
+    for service in services:
+        cgroup = os.path.join(cgroup_root, '{}.service'.format(service))
+        try:
+            memory.append('manila_service_memory_bytes{{service="{}"}} {}'
+                          .format(service,
+                                  int(_read(os.path.join(cgroup,
+                                                         'memory.current')))))
+            usage = re.search(r'^usage_usec (\d+)$',
+                              _read(os.path.join(cgroup, 'cpu.stat')), re.M)
+            if usage:
+                cpu.append('manila_service_cpu_seconds_total'
+                           '{{service="{}"}} {}'
+                           .format(service, int(usage.group(1)) / 1000000.0))
+        except (OSError, ValueError):
+            continue
+    return ([
+        '# HELP manila_service_memory_bytes Memory used by the service.',
+        '# TYPE manila_service_memory_bytes gauge',
+    ] + memory + [
+        '# HELP manila_service_cpu_seconds_total CPU time used by the '
+        'service.',
+        '# TYPE manila_service_cpu_seconds_total counter',
+    ] + cpu)
+
+
+def wsgi_process_metrics(proc_root='/proc'):
+    """Return the number of manila-api WSGI daemon processes."""
+    count = 0
+    for pid in os.listdir(proc_root):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc_root, pid, 'cmdline'), 'rb') as f:
+                if f.read().startswith(WSGI_PROCESS_PREFIX):
+                    count += 1
+        except OSError:
+            continue
+    return [
+        '# HELP manila_wsgi_processes manila-api WSGI daemon processes.',
+        '# TYPE manila_wsgi_processes gauge',
+        'manila_wsgi_processes {}'.format(count),
+    ]
+
+
+def hook_metrics(path):
+    """Return the duration of the last charm hook, and the count of
+    suppressed plugin auth writes, as recorded by the charm.
+    """
+    try:
+        data = json.loads(_read(path))
+        hook, duration, timestamp = (data['hook'], float(data['duration']),
+                                     float(data['timestamp']))
+        suppressed = int(data.get('plugin_auth_suppressed', 0))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return []
+    return [
+        '# HELP manila_charm_last_hook_duration_seconds Duration of the last '
+        'charm hook.',
+        '# TYPE manila_charm_last_hook_duration_seconds gauge',
+        'manila_charm_last_hook_duration_seconds{{hook="{}"}} {}'
+        .format(hook, duration),
+        '# HELP manila_charm_last_hook_timestamp_seconds When the last charm '
+        'hook finished.',
+        '# TYPE manila_charm_last_hook_timestamp_seconds gauge',
+        'manila_charm_last_hook_timestamp_seconds {}'.format(timestamp),
+        '# HELP manila_charm_plugin_auth_writes_suppressed_total Unchanged '
+        'auth data writes to the manila plugins that were skipped.',
+        '# TYPE manila_charm_plugin_auth_writes_suppressed_total counter',
+        'manila_charm_plugin_auth_writes_suppressed_total {}'
+        .format(suppressed),
+    ]
+
+
+class Exporter(object):
+
+    def __init__(self, access_log, services, hook_metrics_file,
+                 compression_log=None,
+                 cgroup_root='/sys/fs/cgroup/system.slice',
+                 proc_root='/proc'):
+        self.access_log = AccessLogStats(access_log)
+        self.compression_log = (CompressionLogStats(compression_log)
+                                if compression_log else None)
+        self.services = services
+        self.hook_metrics_file = hook_metrics_file
+        self.cgroup_root = cgroup_root
+        self.proc_root = proc_root
+
+    def metrics(self):
+        lines = (self.access_log.metrics() +
+                 service_metrics(self.services, self.cgroup_root) +
+                 wsgi_process_metrics(self.proc_root) +
+                 hook_metrics(self.hook_metrics_file))
+        if self.compression_log:
+            lines += self.compression_log.metrics()
+        return '\n'.join(lines) + '\n'
+
+
+def make_handler(exporter):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = exporter.metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                          http.server.HTTPServer):
+    """An HTTP server that handles each request in a thread.
+
+    This is http.server.ThreadingHTTPServer, which is only in Python 3.7 and
+    later; xenial and bionic units have 3.5 and 3.6.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, *args, **kwargs):
+        if ':' in server_address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(server_address, *args, **kwargs)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--address', default='')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--access-log', required=True)
+    parser.add_argument('--hook-metrics', required=True)
+    parser.add_argument('--compression-log')
+    parser.add_argument('--service', action='append', default=[],
+                        dest='services')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    exporter = Exporter(args.access_log, args.services, args.hook_metrics,
+                        compression_log=args.compression_log)
+    # prime the log positions so that only new requests are counted.
+    exporter.access_log.update()
+    if exporter.compression_log:
+        exporter.compression_log.update()
+    server = ThreadingHTTPServer((args.address, args.port),
+                                 make_handler(exporter))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
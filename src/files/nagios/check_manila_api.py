@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Nagios check for the latency and error rate of the manila API.
+
+Two modes are supported:
+
+  versions:   time an unauthenticated GET on the versions document at a URL.
+  access-log: compute the p95 latency and 5xx rate of the requests in the
+              manila access log over a sliding window.  The log format must
+              end with the request duration in microseconds (%D).
+"""
+
+import argparse
+import datetime
+import math
+import os
+import re
+import ssl
+import sys
+import time
+import urllib.error
+import urllib.request
+
+OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
+STATUS = {OK: 'OK', WARNING: 'WARNING', CRITICAL: 'CRITICAL',
+          UNKNOWN: 'UNKNOWN'}
+
+# '<host> <ident> <user> [<time>] "<request>" <status> <bytes> ... <usecs>'
+ACCESS_LOG_RE = re.compile(
+    r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "[^"]*" (?P<status>\d{3}) '
+    r'.* (?P<duration>\d+)$')
+ACCESS_LOG_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+
+
+def _level(value, warn, crit):
+    if value >= crit:
+        return CRITICAL
+    if value >= warn:
+        return WARNING
+    return OK
+
+
+def check_versions(url, warn, crit, timeout=10):
+    """Time a GET of the versions document at `url`.
+
+    :param url: the URL to GET.
+    :param warn: warning threshold, in milliseconds.
+    :param crit: critical threshold, in milliseconds.
+    :param timeout: request timeout, in seconds.
+    :returns: (status, message)
+    """
+    # the check is against the local unit, so the certificate (if any) won't
+    # match the address being used.
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    start = time.time()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout,
+                                    context=context) as response:
+            response.read()
+            code = response.status
+    except urllib.error.HTTPError as e:
+        # the versions document is served with 300 Multiple Choices.
+        code = e.code
+    except Exception as e:
+        return CRITICAL, "{} failed: {}".format(url, e)
+    elapsed = (time.time() - start) * 1000
+    if code >= 500:
+        return CRITICAL, "{} returned {}".format(url, code)
+    status = _level(elapsed, warn, crit)
+    return status, "{} returned {} in {:.0f}ms|time={:.0f}ms;{};{}".format(
+        url, code, elapsed, elapsed, warn, crit)
+
+
+def read_tail(path, max_bytes):
+    """Return the complete lines in the last `max_bytes` of `path`."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        # read one extra byte so that a line starting exactly at the window
+        # boundary isn't treated as partial.
+        f.seek(max(0, size - max_bytes - 1))
+        data = f.read()
+    lines = data.decode('utf-8', 'replace').split('\n')
+    if size > max_bytes:
+        # the first line is partial (or empty).
+        lines = lines[1:]
+    return [line for line in lines if line]
+
+
+def access_log_stats(lines, window, now=None):
+    """Compute request stats for the access log lines in the last `window`
+    seconds.
+
+    :returns: (requests, p95 latency in ms or None, 5xx percentage)
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    since = now - datetime.timedelta(seconds=window)
+    durations = []
+    errors = 0
+    for line in lines:
+        match = ACCESS_LOG_RE.match(line.strip())
+        if not match:
+            continue
+        try:
+            when = datetime.datetime.strptime(match.group('time'),
+                                              ACCESS_LOG_TIME_FORMAT)
+        except ValueError:
+            continue
+        if when < since:
+            continue
+        durations.append(int(match.group('duration')) / 1000.0)
+        if match.group('status').startswith('5'):
+            errors += 1
+    if not durations:
+        return 0, None, 0.0
+    durations.sort()
+    p95 = durations[max(0, math.ceil(0.95 * len(durations)) - 1)]
+    return len(durations), p95, 100.0 * errors / len(durations)
+
+
+def check_access_log(path, window, warn_p95, crit_p95, warn_5xx, crit_5xx,
+                     max_bytes=10 * 1024 * 1024, now=None):
+    """Check the p95 latency and 5xx rate in the access log.
+
+    :returns: (status, message)
+    """
+    try:
+        lines = read_tail(path, max_bytes)
+    except OSError as e:
+        return UNKNOWN, "Can't read {}: {}".format(path, e)
+    count, p95, error_rate = access_log_stats(lines, window, now=now)
+    if not count:
+        return OK, "No requests in the last {}s".format(window)
+    status = max(_level(p95, warn_p95, crit_p95),
+                 _level(error_rate, warn_5xx, crit_5xx))
+    return status, (
+        "{} requests in the last {}s, p95 {:.0f}ms, 5xx {:.1f}%"
+        "|requests={} p95={:.0f}ms;{};{} errors={:.1f}%;{};{}".format(
+            count, window, p95, error_rate,
+            count, p95, warn_p95, crit_p95, error_rate, warn_5xx, crit_5xx))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='mode', required=True)
+    versions = sub.add_parser('versions')
+    versions.add_argument('--url', required=True)
+    versions.add_argument('--warn', type=float, required=True,
+                          help='latency warning threshold (ms)')
+    versions.add_argument('--crit', type=float, required=True,
+                          help='latency critical threshold (ms)')
+    versions.add_argument('--timeout', type=float, default=10)
+    access_log = sub.add_parser('access-log')
+    access_log.add_argument('--log', required=True)
+    access_log.add_argument('--window', type=int, required=True,
+                            help='sliding window (seconds)')
+    access_log.add_argument('--warn-p95', type=float, required=True)
+    access_log.add_argument('--crit-p95', type=float, required=True)
+    access_log.add_argument('--warn-5xx', type=float, required=True)
+    access_log.add_argument('--crit-5xx', type=float, required=True)
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    if args.mode == 'versions':
+        status, message = check_versions(args.url, args.warn, args.crit,
+                                         timeout=args.timeout)
+    else:
+        status, message = check_access_log(
+            args.log, args.window, args.warn_p95, args.crit_p95,
+            args.warn_5xx, args.crit_5xx)
+    print("{}: {}".format(STATUS[status], message))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -16,12 +16,23 @@
 # bare functions are provided to the reactive handlers to perform the functions
 # needed on the class.
 
+import ast
 import collections
+import contextlib
+import glob
+import hashlib
+import json
 import os
 import re
+import shutil
 import subprocess
+import time
 
+import charmhelpers.contrib.openstack.utils as os_utils
+import charmhelpers.core.hookenv as hookenv
 import charmhelpers.core.host as host
+import charmhelpers.core.unitdata as unitdata
+import charmhelpers.fetch as fetch
 import charmhelpers.contrib.charmsupport.nrpe as nrpe
 import charms_openstack.charm
 import charms_openstack.adapters
@@ -44,15 +55,195 @@ MANILA_LOGGING_CONF = MANILA_DIR + "logging.conf"
 MANILA_API_PASTE_CONF = MANILA_DIR + "api-paste.ini"
 MANILA_WEBSERVER_SITE = 'manila-api'
 MANILA_WSGI_CONF = '/etc/apache2/sites-available/manila-api.conf'
+MANILA_ACCESS_LOG = '/var/log/apache2/manila_access.log'
+# written by mod_deflate when 'api-compression' is set.
+MANILA_DEFLATE_LOG = '/var/log/apache2/manila_deflate.log'
+NAGIOS_CHECK_API = 'check_manila_api.py'
+NAGIOS_CHECK_API_ACCESS_LOG = 'check_manila_api_access_log'
+NAGIOS_PLUGINS_DIR = '/usr/local/lib/nagios/plugins'
+# Lets the nagios user run the access log check, and nothing else, as root.
+NAGIOS_SUDOERS = '/etc/sudoers.d/manila-nagios'
+MANILA_EXPORTER = '/usr/local/bin/manila-exporter'
+MANILA_EXPORTER_SERVICE = 'manila-exporter'
+# the exporter runs as this user, which is given read access to the manila
+# apache2 logs only.
+MANILA_EXPORTER_USER = 'manila-exporter'
+MANILA_EXPORTER_UNIT = '/etc/systemd/system/manila-exporter.service'
+MANILA_EXPORTER_DIR = '/var/lib/manila-exporter'
+MANILA_EXPORTER_SCRAPE_CONF = '/etc/manila-exporter/scrape.yaml'
+# written at the end of each hook, and read by the exporter.
+MANILA_HOOK_METRICS = os.path.join(MANILA_EXPORTER_DIR, 'hook.json')
 LOCAL_PLUGIN_RELATION = "manila-plugin.available"
 REMOTE_PLUGIN_RELATION = "remote-manila-plugin.available"
 PLUGIN_RELATIONS = (LOCAL_PLUGIN_RELATION,
                     REMOTE_PLUGIN_RELATION,)
+# unitdata key holding the restarts/reloads queued during this (or a paused)
+# hook, as {service: 'restart'|'reload'}.
+PENDING_RESTARTS_KEY = 'manila.pending-restarts'
+# The order in which queued restarts are run: the RPC services before the API
+# that calls them, and haproxy last so that it sees healthy backends.
+RESTART_ORDER = ['manila-scheduler',
+                 'manila-data',
+                 'manila-share',
+                 'apache2',
+                 'haproxy']
+# Precedence of the queued service actions; a stronger action supersedes a
+# weaker one for the same service.
+SERVICE_ACTION_PRIORITY = {
+    'hup': 0,
+    'reload': 1,
+    'restart': 2,
+}
+# The oslo.service based services; these re-read their mutable options on
+# SIGHUP rather than needing a restart.
+OSLO_SERVICES = ['manila-scheduler',
+                 'manila-data',
+                 'manila-share']
+# With 'share-service-per-backend', each local backend is served by its own
+# manila-share@<backend> instance, configured by a fragment that only
+# enables that backend.
+MANILA_SHARE_INSTANCE_UNIT = '/etc/systemd/system/manila-share@.service'
+MANILA_SHARE_BACKEND_DIR = MANILA_DIR + 'manila-share.d'
+MANILA_SHARE_BACKEND_CONF = os.path.join(MANILA_SHARE_BACKEND_DIR, '{}.conf')
+MANILA_PURGE_CRON = '/etc/cron.d/manila-purge-deleted-rows'
+MANILA_PURGE_LOG = '/var/log/manila/manila-purge-deleted-rows.log'
+# A cron time field: numbers, names, '*', ranges, lists and steps.
+CRON_FIELD_RE = re.compile(r'^[0-9A-Za-z*,/-]+$')
+# Lines, per config file, that only set mutable oslo options (or log levels)
+# and so can be applied with a SIGHUP rather than a restart.
+MUTABLE_CONFIG_LINES = {
+    MANILA_CONF: re.compile(r'^debug\s*='),
+    MANILA_LOGGING_CONF: re.compile(r'^level\s*='),
+}
+MANILA_MIGRATIONS_GLOB = (
+    '/usr/lib/python*/dist-packages/manila/db/migrations/alembic/versions/'
+    '*.py')
+# leader setting recording the package version and alembic head of the last
+# database sync.
+DB_SYNC_MARKER_KEY = 'manila-db-sync-marker'
+# The services that serve the API; these keep running through an OpenStack
+# upgrade and are restarted last.
+API_SERVICES = ('apache2', 'haproxy')
+
+# The oslo.log default_log_levels; 'log-level-overrides' is merged over these
+# so that setting one logger doesn't reset the others to the root level.
+OSLO_DEFAULT_LOG_LEVELS = collections.OrderedDict([
+    ('amqp', 'WARN'),
+    ('amqplib', 'WARN'),
+    ('boto', 'WARN'),
+    ('qpid', 'WARN'),
+    ('sqlalchemy', 'WARN'),
+    ('suds', 'INFO'),
+    ('oslo.messaging', 'INFO'),
+    ('oslo_messaging', 'INFO'),
+    ('iso8601', 'WARN'),
+    ('requests.packages.urllib3.connectionpool', 'WARN'),
+    ('urllib3.connectionpool', 'WARN'),
+    ('websocket', 'WARN'),
+    ('requests.packages.urllib3.util.retry', 'WARN'),
+    ('urllib3.util.retry', 'WARN'),
+    ('keystonemiddleware', 'WARN'),
+    ('routes.middleware', 'WARN'),
+    ('stevedore', 'WARN'),
+    ('taskflow', 'WARN'),
+    ('keystoneauth', 'WARN'),
+    ('oslo.cache', 'INFO'),
+    ('oslo_policy', 'INFO'),
+    ('dogpile.core.dogpile', 'INFO'),
+])
+LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARN', 'WARNING', 'INFO', 'DEBUG')
+
+# systemd drop-in rendered from 'service-resource-controls', and the
+# directives it may set.
+SYSTEMD_RESOURCE_CONTROLS_CONF = (
+    '/etc/systemd/system/{}.service.d/50-juju-resource-controls.conf')
+RESOURCE_CONTROLS = ('CPUWeight', 'CPUQuota', 'MemoryHigh', 'MemoryMax',
+                     'IOWeight', 'CPUAffinity')
+
+HAPROXY_DEFAULT_MAXCONN = 20000
+# haproxy server weights are scaled so that the largest unit gets this weight.
+HAPROXY_MAX_WEIGHT = 100
+# cluster relation keys used to share each unit's API capacity.
+API_CAPACITY_KEY = 'api-capacity'
+WSGI_CAPACITY_KEY = 'wsgi-capacity'
+CPU_CORES_KEY = 'cpu-cores'
+PROFILER_DEFAULT_CONNECTION_STRING = 'messaging://'
+# OSProfiler backends that need python3-redis.
+PROFILER_REDIS_SCHEMES = ('redis://', 'sentinel://')
+# unitdata key holding the manila package version that the cached API
+# version documents were served by.
+VERSION_CACHE_PACKAGE_KEY = 'manila.version-cache-package'
+HAPROXY_BALANCE_ALGORITHMS = ('leastconn', 'roundrobin', 'static-rr',
+                              'source', 'first')
 
 # select the default release function and ssl feature
 charms_openstack.charm.use_defaults('charm.default-select-release')
 
 
+def immutable_config_hash(path):
+    """Return a hash of `path` that ignores the lines in MUTABLE_CONFIG_LINES.
+
+    :param path: the config file to hash.
+    :returns: the sha256 hex digest, or None if `path` has no mutable lines
+        or doesn't exist.
+    """
+    mutable = MUTABLE_CONFIG_LINES.get(path)
+    if mutable is None or not os.path.exists(path):
+        return None
+    sha = hashlib.sha256()
+    with open(path) as f:
+        for line in f:
+            if not mutable.match(line):
+                sha.update(line.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def record_hook_duration(hook, duration, plugin_auth_suppressed=0):
+    """Record the duration of a hook for the metrics exporter.
+
+    Does nothing unless the exporter has been configured.
+
+    :param hook: the name of the hook.
+    :param duration: the duration of the hook, in seconds.
+    :param plugin_auth_suppressed: the number of unchanged plugin auth writes
+        skipped so far.
+    """
+    if not os.path.isdir(MANILA_EXPORTER_DIR):
+        return
+    host.write_file(MANILA_HOOK_METRICS,
+                    json.dumps({'hook': hook,
+                                'duration': duration,
+                                'timestamp': time.time(),
+                                'plugin_auth_suppressed':
+                                    plugin_auth_suppressed}).encode('utf-8'),
+                    perms=0o644)
+
+
+def format_host(address):
+    """Return `address` for use in a URL or host:port, bracketed if IPv6."""
+    return '[{}]'.format(address) if ':' in address else address
+
+
+def remove_nagios_sudoers():
+    """Remove the sudoers rule for the access log check, if installed."""
+    if os.path.exists(NAGIOS_SUDOERS):
+        os.remove(NAGIOS_SUDOERS)
+
+
+@contextlib.contextmanager
+def timed_phase(timings, phase):
+    """Record how long the wrapped block took in `timings`.
+
+    :param timings: dict of {phase: seconds} to update.
+    :param phase: the name of the phase.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[phase] = time.time() - start
+
+
 def strip_join(s, divider=" "):
     """Cleanup the string passed, split on whitespace and then rejoin it
     cleanly
@@ -66,6 +257,94 @@ def strip_join(s, divider=" "):
         re.split(r'\s+', re.sub(r'([^\s\w-])+', '', (s or ""))))
 
 
+def parse_log_level_overrides(s):
+    """Parse the 'log-level-overrides' option.
+
+    :param s: a whitespace or comma separated list of <logger>=<LEVEL>
+    :returns: OrderedDict of logger: LEVEL
+    :raises ValueError: if an entry isn't of the form <logger>=<LEVEL>
+    """
+    overrides = collections.OrderedDict()
+    for entry in re.split(r'[\s,]+', (s or "").strip()):
+        if not entry:
+            continue
+        logger, _, level = entry.partition('=')
+        level = level.upper()
+        if not logger or level not in LOG_LEVELS:
+            raise ValueError("Invalid log level override: '{}'".format(entry))
+        overrides[logger] = level
+    return overrides
+
+
+def migration_revisions(source):
+    """Return the revision and down_revision of an alembic migration script.
+
+    :param source: the Python source of the migration.
+    :returns: dict of 'revision' and 'down_revision' to their values (a
+        string, a tuple of strings, or None) for those that are set.
+    """
+    assignments = {}
+    try:
+        module = ast.parse(source)
+    except SyntaxError:
+        return assignments
+    for node in module.body:
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.AnnAssign):
+            targets = [node.target]
+        else:
+            continue
+        for target in targets:
+            if (isinstance(target, ast.Name) and
+                    target.id in ('revision', 'down_revision')):
+                try:
+                    assignments[target.id] = ast.literal_eval(node.value)
+                except ValueError:
+                    pass
+    return assignments
+
+
+def parse_cron_schedule(s):
+    """Parse the 'purge-deleted-rows-schedule' option.
+
+    :param s: a cron schedule of five fields, or empty.
+    :returns: the schedule, normalised to single spaces; '' if unset.
+    :raises ValueError: if `s` isn't five cron fields on one line.
+    """
+    s = (s or "").strip()
+    if not s:
+        return ''
+    fields = s.split()
+    if ('\n' in s or '\r' in s or len(fields) != 5 or
+            not all(CRON_FIELD_RE.match(field) for field in fields)):
+        raise ValueError("Invalid cron schedule: {!r}".format(s))
+    return ' '.join(fields)
+
+
+def parse_resource_controls(s, services):
+    """Parse the 'service-resource-controls' option.
+
+    :param s: a whitespace separated list of <service>:<Directive>=<value>
+    :param services: the services that may be configured
+    :returns: OrderedDict of service: OrderedDict of directive: value
+    :raises ValueError: if an entry isn't of that form, or names an unknown
+        service or a directive not in RESOURCE_CONTROLS
+    """
+    controls = collections.OrderedDict()
+    for entry in (s or "").split():
+        service, _, setting = entry.partition(':')
+        directive, _, value = setting.partition('=')
+        if not value or directive not in RESOURCE_CONTROLS:
+            raise ValueError("Invalid resource control: '{}'".format(entry))
+        if service not in services:
+            raise ValueError("Unknown service in resource control: '{}'"
+                             .format(entry))
+        controls.setdefault(service, collections.OrderedDict())[
+            directive] = value
+    return controls
+
+
 ###
 # Compute some options to help with template rendering
 ###
@@ -120,6 +399,187 @@ def computed_debug_level(config):
     return "WARNING"
 
 
+@charms_openstack.adapters.config_property
+def computed_log_level_overrides(config):
+    """Return the per-logger level overrides as a list of (logger, level).
+
+    Invalid entries are reported by custom_assess_status_check(); here they
+    just result in no overrides.
+
+    :returns: list of tuples
+    """
+    try:
+        return list(
+            parse_log_level_overrides(config.log_level_overrides).items())
+    except ValueError:
+        return []
+
+
+@charms_openstack.adapters.config_property
+def computed_default_log_levels(config):
+    """Return the oslo.log default_log_levels with the overrides applied.
+
+    :returns: string, comma separated <logger>=<LEVEL>, or None if there are
+        no overrides (so the oslo.log default is left alone).
+    """
+    overrides = computed_log_level_overrides(config)
+    if not overrides:
+        return None
+    levels = OSLO_DEFAULT_LOG_LEVELS.copy()
+    levels.update(overrides)
+    return ','.join('{}={}'.format(k, v) for k, v in levels.items())
+
+
+@charms_openstack.adapters.config_property
+def computed_profiler_connection_string(config):
+    """Return the OSProfiler connection string for the [profiler] section.
+
+    :returns: string
+    """
+    return (config.profiler_connection_string or
+            PROFILER_DEFAULT_CONNECTION_STRING)
+
+
+@charms_openstack.adapters.config_property
+def computed_wsgi_capacity(config):
+    """Return the number of requests the manila-api WSGI daemon can serve at
+    once on this unit (processes x threads).
+
+    :returns: int
+    """
+    context = config.wsgi_worker_context
+    return int(context['processes']) * int(context.get('threads') or 1)
+
+
+def effective_api_capacity(processes, threads, cores):
+    """Return the number of requests a unit can usefully serve at once.
+
+    WSGI processes beyond the number of cores don't add throughput for CPU
+    bound requests, so the process count is capped at the core count.
+
+    :param processes: number of WSGI processes.
+    :param threads: number of threads per WSGI process.
+    :param cores: number of usable CPU cores.
+    :returns: int
+    """
+    return max(1, min(processes, cores or processes)) * max(1, threads)
+
+
+def local_api_capacity(config):
+    """Return the effective API capacity of this unit.
+
+    :param config: the configuration adapter.
+    :returns: int
+    """
+    context = config.wsgi_worker_context
+    return effective_api_capacity(int(context['processes']),
+                                  int(context.get('threads') or 1),
+                                  len(os.sched_getaffinity(0)))
+
+
+def peer_capacities(key):
+    """Return the capacities that the peers have published under key.
+
+    :param key: API_CAPACITY_KEY or WSGI_CAPACITY_KEY
+    :returns: dict of unit name ('manila/1' form) to int, for the peers
+        that have published one.
+    """
+    capacities = {}
+    for rid in hookenv.relation_ids('cluster'):
+        for unit in hookenv.related_units(rid):
+            capacity = hookenv.relation_get(key, unit, rid)
+            if capacity:
+                capacities[unit] = int(capacity)
+    return capacities
+
+
+@charms_openstack.adapters.config_property
+def computed_haproxy_weights(config):
+    """Return the haproxy weight of each unit's manila-api backend.
+
+    The weights are proportional to the API capacity that each unit
+    publishes on the cluster relation, scaled so that the largest unit has
+    HAPROXY_MAX_WEIGHT.  Units that haven't published a capacity get the
+    maximum weight.
+
+    :returns: dict of unit name ('manila-0' form) to weight
+    """
+    capacities = peer_capacities(API_CAPACITY_KEY)
+    if not capacities:
+        return collections.defaultdict(lambda: HAPROXY_MAX_WEIGHT)
+    capacities[hookenv.local_unit()] = local_api_capacity(config)
+    largest = max(capacities.values())
+    weights = collections.defaultdict(lambda: HAPROXY_MAX_WEIGHT)
+    for unit, capacity in capacities.items():
+        weights[unit.replace('/', '-')] = max(
+            1, int(round(HAPROXY_MAX_WEIGHT * capacity / largest)))
+    return weights
+
+
+@charms_openstack.adapters.config_property
+def computed_haproxy_server_maxconn(config):
+    """Return the maximum number of connections haproxy passes to each
+    unit's manila-api backend at once.
+
+    This is 'haproxy-server-maxconn' for every unit if set.  Otherwise it is
+    only limited when the frontends run in HTTP mode, to the WSGI capacity
+    that each unit publishes on the cluster relation, so that excess requests
+    queue in haproxy (where 'api-max-queue' applies) rather than in apache2.
+    Units that haven't published a WSGI capacity are left unlimited, as are
+    all units in TCP mode, where idle keep-alive connections would hold the
+    slots and add queueing latency.
+
+    :returns: dict of unit name ('manila-0' form) to int, or None for no limit
+    """
+    if config.haproxy_server_maxconn:
+        return collections.defaultdict(lambda: config.haproxy_server_maxconn)
+    maxconn = collections.defaultdict(lambda: None)
+    if computed_haproxy_http_mode(config):
+        capacities = peer_capacities(WSGI_CAPACITY_KEY)
+        capacities[hookenv.local_unit()] = computed_wsgi_capacity(config)
+        for unit, capacity in capacities.items():
+            maxconn[unit.replace('/', '-')] = capacity
+    return maxconn
+
+
+@charms_openstack.adapters.config_property
+def computed_haproxy_maxconn(config):
+    """Return the maximum number of concurrent connections for haproxy.
+
+    :returns: int
+    """
+    return config.haproxy_maxconn or HAPROXY_DEFAULT_MAXCONN
+
+
+@charms_openstack.adapters.config_property
+def computed_haproxy_http_mode(config):
+    """Return whether the haproxy API frontends should run in HTTP mode.
+
+    HTTP mode is only used when admission control is configured, so that
+    rejected requests get a quick '429 Too Many Requests' response.
+
+    :returns: boolean
+    """
+    return bool(config.api_rate_limit or
+                config.api_client_max_connections or
+                config.api_max_queue)
+
+
+@charms_openstack.adapters.config_property
+def computed_haproxy_client_key(config):
+    """Return the haproxy sample that identifies the client of a request.
+
+    If TLS is enabled, apache2 terminates it in front of haproxy, so every
+    request comes from apache2; the client address is then the last
+    X-Forwarded-For entry, which apache2 appends.
+
+    :returns: string
+    """
+    if config.charm_instance.get_state('ssl.enabled'):
+        return 'req.hdr_ip(X-Forwarded-For,-1)'
+    return 'src'
+
+
 class TransportURLAdapter(charms_openstack.adapters.RabbitMQRelationAdapter):
     """Add Transport URL to RabbitMQRelationAdapter
     TODO: Move to charms.openstack.adapters
@@ -208,6 +668,10 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
     # This is the command to sync the database
     sync_cmd = ['sudo', 'manila-manage', 'db', 'sync']
 
+    # This is the command to purge soft-deleted rows; the age in days is
+    # appended.
+    purge_cmd = ['sudo', 'manila-manage', 'db', 'purge']
+
     # Package for release version detection
     release_pkg = 'manila-common'
 
@@ -236,9 +700,23 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
         # BUG: #2012457: only start manila-share if a local share server is
         # going to be configured.
         if self.get_adapter(LOCAL_PLUGIN_RELATION):
-            services.append('manila-share')
+            services.extend(self.share_services)
         return services
 
+    @property
+    def share_services(self):
+        """Return the manila-share services for the local backends.
+
+        This is 'manila-share', or with 'share-service-per-backend' a
+        'manila-share@<backend>' instance per local backend.
+
+        :returns: list of service names
+        """
+        if not self.options.share_service_per_backend:
+            return ['manila-share']
+        return ['manila-share@{}'.format(backend)
+                for backend in self.configured_local_backends]
+
     @property
     def restart_map(self):
         services = self.services
@@ -251,6 +729,14 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
 
     ha_resources = ['vips', 'haproxy', 'dnsha']
 
+    # Set once an assess_status() has been deferred to the end of the hook.
+    _assess_status_deferred = False
+    # Set once the pending restarts are due to be run at the end of the hook.
+    _restarts_deferred = False
+    # The number of OpenStack upgrades run in this hook; charm instances made
+    # before the last one are for the old release.
+    upgrades = 0
+
     # Custom charm configuration
 
     def install(self):
@@ -266,6 +752,151 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
         host.service_pause('manila-api')
         self.assess_status()
 
+    def assess_status(self):
+        """Defer assessing the status of the unit to the end of the hook.
+
+        Several handlers can ask for the status to be assessed in the same
+        hook, and each assessment checks the services and ports.  Only the
+        first request registers a callback; the status is then assessed once,
+        after all of the handlers have run.
+        """
+        if ManilaCharm._assess_status_deferred:
+            return
+        ManilaCharm._assess_status_deferred = True
+        hookenv.atexit(self._run_deferred_assess_status)
+
+    def _run_deferred_assess_status(self):
+        """Actually assess the status; called at the end of the hook.
+
+        The queued restarts are run first, so that the status describes the
+        services as they will be after the hook; the atexit callbacks run in
+        the reverse order of registration, which would otherwise put this
+        before run_pending_restarts().
+        """
+        ManilaCharm._assess_status_deferred = False
+        self.run_pending_restarts()
+        super().assess_status()
+
+    @contextlib.contextmanager
+    def restart_on_change(self, restart_map=None):
+        """Queue restarts for the services whose config files change in the
+        wrapped block.
+
+        Unlike the charms.openstack default, the services are not restarted
+        straight away; see queue_service_action().  If only mutable options
+        changed in a file (see MUTABLE_CONFIG_LINES), the oslo services are
+        sent a SIGHUP and the others reloaded, rather than restarted.
+
+        :param restart_map: {path: [services]} to watch; defaults to
+            full_restart_map
+        """
+        if restart_map is None:
+            restart_map = self.full_restart_map
+        checksums = {path: (host.path_hash(path), immutable_config_hash(path))
+                     for path in restart_map.keys()}
+        yield
+        for path, services in restart_map.items():
+            full_hash, immutable_hash = checksums[path]
+            if host.path_hash(path) == full_hash:
+                continue
+            mutable_only = (immutable_hash is not None and
+                            immutable_config_hash(path) == immutable_hash)
+            for service in services:
+                if not mutable_only:
+                    action = 'restart'
+                elif service.split('@')[0] in OSLO_SERVICES:
+                    action = 'hup'
+                else:
+                    action = 'reload'
+                self.queue_service_action(service, action)
+
+    def queue_service_action(self, service, action):
+        """Queue a restart, reload or SIGHUP ('hup') of `service` for the end
+        of the hook.
+
+        Requests are de-duplicated, and a stronger action supersedes a weaker
+        one for the same service (see SERVICE_ACTION_PRIORITY).  The queue is
+        kept in unitdata so that restarts requested while the unit is paused
+        are run at the end of the first hook after it is resumed (see the
+        reactive handlers), or by the 'restart-pending-services' action.
+
+        :param service: the name of the service
+        :param action: 'restart', 'reload' or 'hup'
+        """
+        db = unitdata.kv()
+        pending = db.get(PENDING_RESTARTS_KEY, {})
+        current = pending.get(service)
+        if (current is None or SERVICE_ACTION_PRIORITY[action] >
+                SERVICE_ACTION_PRIORITY[current]):
+            pending[service] = action
+        db.set(PENDING_RESTARTS_KEY, pending)
+        if not ManilaCharm._restarts_deferred:
+            ManilaCharm._restarts_deferred = True
+            hookenv.atexit(self.run_pending_restarts)
+
+    @property
+    def pending_restarts(self):
+        """Return the queued service actions in the order they will be run.
+
+        :returns: list of (service, action) tuples
+        """
+        def _order(service):
+            try:
+                # manila-share@<backend> instances go with manila-share.
+                return (RESTART_ORDER.index(service.split('@')[0]), service)
+            except ValueError:
+                return (len(RESTART_ORDER), service)
+
+        pending = unitdata.kv().get(PENDING_RESTARTS_KEY, {})
+        return [(service, pending[service])
+                for service in sorted(pending, key=_order)]
+
+    def run_pending_restarts(self):
+        """Run the queued service actions, unless the unit is paused.
+
+        A service queued for a HUP that isn't running is restarted instead.
+        An action that fails is logged and left queued for the next hook,
+        and the others are still run.
+
+        :returns: the list of (service, action) tuples that were run.
+        """
+        ManilaCharm._restarts_deferred = False
+        if os_utils.is_unit_paused_set():
+            hookenv.log("Unit is paused; deferring service restarts",
+                        level=hookenv.DEBUG)
+            return []
+        done = []
+        failed = {}
+        for service, action in self.pending_restarts:
+            try:
+                if action == 'hup' and not host.service_running(service):
+                    # there is no main process to signal; starting the
+                    # service picks up the new config.
+                    action = 'restart'
+                if action == 'restart':
+                    host.service_restart(service)
+                elif action == 'hup':
+                    # signal only the main process; oslo.service re-reads the
+                    # config files and applies the mutable options.
+                    subprocess.check_call(['systemctl', 'kill',
+                                           '--kill-who=main', '--signal=HUP',
+                                           service])
+                else:
+                    host.service_reload(service, restart_on_failure=True)
+            except subprocess.CalledProcessError as e:
+                hookenv.log("Failed to {} {}: {}".format(action, service, e),
+                            level=hookenv.WARNING)
+                failed[service] = action
+                continue
+            done.append((service, action))
+        db = unitdata.kv()
+        if failed:
+            db.set(PENDING_RESTARTS_KEY, failed)
+        else:
+            db.unset(PENDING_RESTARTS_KEY)
+        db.flush()
+        return done
+
     def custom_assess_status_check(self):
         """Verify that the configuration provided is valid and thus the service
         is ready to go.  This will return blocked if the configuration is not
@@ -285,6 +916,42 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
             return ('blocked',
                     "'default-share-backend:{}' is not a configured backend"
                     .format(default_share_backend))
+        if options.haproxy_balance not in HAPROXY_BALANCE_ALGORITHMS:
+            return ('blocked',
+                    "'haproxy-balance:{}' is not one of {}"
+                    .format(options.haproxy_balance,
+                            ', '.join(HAPROXY_BALANCE_ALGORITHMS)))
+        try:
+            parse_log_level_overrides(options.log_level_overrides)
+        except ValueError as e:
+            return 'blocked', "'log-level-overrides': {}".format(e)
+        try:
+            self.resource_controls
+        except ValueError as e:
+            return 'blocked', "'service-resource-controls': {}".format(e)
+        try:
+            parse_cron_schedule(options.purge_deleted_rows_schedule)
+        except ValueError as e:
+            return 'blocked', "'purge-deleted-rows-schedule': {}".format(e)
+        if options.profiler and not options.profiler_hmac_key:
+            return ('blocked',
+                    "'profiler' is set but 'profiler-hmac-key' is not")
+        if (options.data_mount_tmp_location and
+                not os.path.isabs(options.data_mount_tmp_location)):
+            return ('blocked',
+                    "'data-mount-tmp-location:{}' is not an absolute path"
+                    .format(options.data_mount_tmp_location))
+        if (options.log_rate_limit_interval and
+                options.log_rate_limit_burst < 1):
+            return ('blocked',
+                    "'log-rate-limit-interval' is set but "
+                    "'log-rate-limit-burst' is not")
+        _, conflicts = self.plugin_config_index
+        if conflicts:
+            return ('blocked',
+                    "Conflicting config from backend charms for: {}"
+                    .format(', '.join(sorted(set(
+                        name for _, name in conflicts)))))
         return None, None
 
     def get_amqp_credentials(self):
@@ -313,26 +980,202 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
                 username=self.options.database_user, )
         ]
 
+    @property
+    def keystone_endpoints(self):
+        """Return the endpoints that this charm registers with keystone.
+
+        Each entry is a tuple of (prefix, service, public_url, internal_url,
+        admin_url); adding another API version only needs another entry here.
+
+        :returns: list of tuples
+        """
+        return [
+            ('v1', self.service_type,
+             self.public_url, self.internal_url, self.admin_url),
+            ('v2', self.service_type_v2,
+             self.public_url_v2, self.internal_url_v2, self.admin_url_v2),
+        ]
+
+    @property
+    def alembic_head(self):
+        """Return the alembic head revision shipped by the installed package.
+
+        This reads the migration scripts rather than asking manila-manage, so
+        that it is cheap enough to check on every hook.
+
+        :returns: the head revision(s) as a string, or None if not found.
+        """
+        revisions = set()
+        down_revisions = set()
+        for migration in glob.glob(MANILA_MIGRATIONS_GLOB):
+            with open(migration) as f:
+                assignments = migration_revisions(f.read())
+            if assignments.get('revision'):
+                revisions.add(assignments['revision'])
+            # a merge migration has a tuple of down revisions.
+            down_revision = assignments.get('down_revision') or ()
+            if isinstance(down_revision, str):
+                down_revision = (down_revision, )
+            down_revisions.update(down_revision)
+        heads = sorted(revisions - down_revisions)
+        return ','.join(heads) or None
+
+    def db_sync_marker(self):
+        """Return a marker identifying the schema that db sync produces.
+
+        :returns: string of the form '<package version>:<alembic head>'
+        """
+        version = fetch.get_installed_version(self.release_pkg)
+        return '{}:{}'.format(version.ver_str if version else None,
+                              self.alembic_head)
+
+    def db_sync(self, force=False, restart=True):
+        """Sync the database on the leader if the schema may have changed.
+
+        'manila-manage db sync' is slow to start and takes the alembic locks,
+        so it is only run when the installed package version or alembic head
+        differs from those recorded at the last sync.
+
+        :param force: run the sync even if the marker is unchanged.
+        :param restart: restart the services after the sync.
+        :returns: True if the sync was run.
+        """
+        if not hookenv.is_leader():
+            return False
+        marker = self.db_sync_marker()
+        if not force and hookenv.leader_get(DB_SYNC_MARKER_KEY) == marker:
+            hookenv.log("Database schema is current ({}); skipping db sync"
+                        .format(marker), level=hookenv.DEBUG)
+            return False
+        subprocess.check_call(self.sync_cmd)
+        hookenv.leader_set({'db-sync-done': True,
+                            DB_SYNC_MARKER_KEY: marker})
+        if restart:
+            # Restart services immediately after db sync, as the
+            # charms.openstack default does.
+            self.restart_all()
+        return True
+
+    def fetch_upgrade_packages(self):
+        """Download the packages for the new openstack-origin.
+
+        The new source is configured and the packages that the upgrade will
+        install are downloaded to the apt cache, without installing anything,
+        so this can run while the services are still up.
+        """
+        os_utils.configure_installation_source(
+            self.config[self.source_config_key])
+        fetch.apt_update(fatal=True)
+        fetch.apt_upgrade(options=['--download-only'], fatal=True, dist=True)
+        fetch.apt_install(self.all_packages, options=['--download-only'],
+                          fatal=True)
+
+    def run_upgrade(self, interfaces_list=None):
+        """Upgrade OpenStack, keeping the API serving for as long as possible.
+
+        The packages are downloaded before anything is stopped.  Only the RPC
+        services are stopped for the install; the API services keep serving
+        until the services are restarted, in RESTART_ORDER, once the configs
+        have been rendered and the database synced.
+
+        :param interfaces_list: the interfaces to render the configs with.
+        :returns: collections.OrderedDict of {phase: seconds}
+        """
+        timings = collections.OrderedDict()
+        with timed_phase(timings, 'fetch'):
+            self.fetch_upgrade_packages()
+        with timed_phase(timings, 'stop'):
+            for service in self.services:
+                if service not in API_SERVICES:
+                    host.service_stop(service)
+        with timed_phase(timings, 'install'):
+            self.do_openstack_pkg_upgrade()
+        ManilaCharm.upgrades += 1
+        with timed_phase(timings, 'render'):
+            self.do_openstack_upgrade_config_render(interfaces_list)
+        with timed_phase(timings, 'db-sync'):
+            self.db_sync(restart=False)
+        with timed_phase(timings, 'restart'):
+            for service in self.services:
+                self.queue_service_action(service, 'restart')
+            self.run_pending_restarts()
+        hookenv.log("OpenStack upgrade to {} took {}"
+                    .format(self.release,
+                            ', '.join('{} {:.1f}s'.format(phase, seconds)
+                                      for phase, seconds in timings.items())),
+                    level=hookenv.INFO)
+        return timings
+
+    def purge_deleted_rows(self, age):
+        """Purge rows that were soft-deleted more than `age` days ago.
+
+        :param age: the minimum age, in days, of the rows to purge.
+        :returns: (rows removed, elapsed seconds); rows removed is parsed from
+            the manila-manage output, and is None if it doesn't report them.
+        :rtype: Tuple[Optional[int], float]
+        """
+        start = time.time()
+        output = subprocess.check_output(self.purge_cmd + [str(age)],
+                                         stderr=subprocess.STDOUT,
+                                         universal_newlines=True)
+        counts = re.findall(r'Deleted (\d+) ', output)
+        rows = sum(int(n) for n in counts) if counts else None
+        return rows, time.time() - start
+
+    def configure_purge_cron(self):
+        """Install or remove the cron job that purges soft-deleted rows.
+
+        The job is only installed on the leader (as with db_sync()) and only if
+        'purge-deleted-rows-schedule' is set.  An invalid schedule removes the
+        job, and is left to custom_assess_status_check().
+        """
+        try:
+            schedule = parse_cron_schedule(
+                self.options.purge_deleted_rows_schedule)
+        except ValueError:
+            schedule = ''
+        if schedule and hookenv.is_leader():
+            cmd = ' '.join(self.purge_cmd[1:] +
+                           [str(self.options.purge_deleted_rows_age)])
+            host.write_file(
+                MANILA_PURGE_CRON,
+                '# Managed by juju\n'
+                '{} manila /usr/bin/{} >> {} 2>&1\n'
+                .format(schedule, cmd, MANILA_PURGE_LOG).encode('utf-8'),
+                perms=0o644)
+        elif os.path.exists(MANILA_PURGE_CRON):
+            os.remove(MANILA_PURGE_CRON)
+
+    def publish_api_capacity(self):
+        """Publish this unit's API and WSGI capacities, and its core count,
+        to its peers.
+
+        The peers use these to weight and limit this unit's haproxy backend;
+        see computed_haproxy_weights() and computed_haproxy_server_maxconn().
+        """
+        settings = {
+            API_CAPACITY_KEY: local_api_capacity(self.options),
+            WSGI_CAPACITY_KEY: computed_wsgi_capacity(self.options),
+            CPU_CORES_KEY: len(os.sched_getaffinity(0)),
+        }
+        for rid in hookenv.relation_ids('cluster'):
+            hookenv.relation_set(relation_id=rid,
+                                 relation_settings=settings)
+
     def register_endpoints(self, keystone):
         """Custom function to register the TWO keystone endpoints that this
         charm requires.  'charm' and 'charmv2'.
 
         :param keystone: the keystone relation on which to setup the endpoints
         """
-        # register the first endpoint
-        self._custom_register_endpoints(keystone, 'v1',
-                                        self.service_type,
-                                        self.region,
-                                        self.public_url,
-                                        self.internal_url,
-                                        self.admin_url)
-        # register the second endpoint
-        self._custom_register_endpoints(keystone, 'v2',
-                                        self.service_type_v2,
-                                        self.region,
-                                        self.public_url_v2,
-                                        self.internal_url_v2,
-                                        self.admin_url_v2)
+        for (prefix, service, public_url, internal_url,
+             admin_url) in self.keystone_endpoints:
+            self._custom_register_endpoints(keystone, prefix,
+                                            service,
+                                            self.region,
+                                            public_url,
+                                            internal_url,
+                                            admin_url)
 
     @staticmethod
     def _custom_register_endpoints(keystone, prefix, service, region,
@@ -345,6 +1188,10 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
         function duplicates part of that functionality but enables the
         'multiple' endpoints to be set
 
+        Only the keys whose values differ from what is already published on
+        the relation are written, so that keystone isn't asked to re-process
+        endpoints that haven't changed.
+
         :param keystone: the relation that is keystone.
         :param prefix: the prefix to prepend to '_<var>'
         :param service: the service to set
@@ -361,7 +1208,10 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
             '{}_region'.format(prefix): region,
         }
         for relation in keystone.relations:
-            relation.to_publish_raw.update(relation_info)
+            changed = {k: v for k, v in relation_info.items()
+                       if relation.to_publish_raw.get(k) != v}
+            if changed:
+                relation.to_publish_raw.update(changed)
 
     @property
     def public_url(self):
@@ -423,11 +1273,12 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
                 names.extend(manila_plugin_adapter.relation.names)
         return sorted(set(names))
 
-    def config_lines_for(self, config_file):
-        """Return the list of configuration lines for `config_file` as returned
-        by manila-plugin backend charms.
+    @property
+    def plugin_config_index(self):
+        """Return the configuration chunks from the manila-plugin backend
+        charms, indexed by config file and backend name.
 
-        The configuration from the adapter looks like:
+        The configuration from each adapter looks like:
 
         {
             "<name1>": {
@@ -439,23 +1290,44 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
             },
         }
 
-        :param config_file: string, filename for configuration lines
-        :returns: list of strings: config lines for `config_file`
+        The local adapter is indexed before the remote one, and the names of
+        each in sorted order, so the result doesn't depend on relation order.
+        A chunk identical (by content hash) to one already indexed for the
+        same file is dropped, so a backend that arrives over both relations
+        is only written once.  If a name arrives again with different
+        content, the first chunk wins and the name is recorded as a conflict.
+
+        :returns: ({config file: OrderedDict of name: chunk},
+                   list of (config file, name) conflicts)
         """
-        config_lines = []
-        inverted_config_data = collections.defaultdict(dict)
+        index = collections.defaultdict(collections.OrderedDict)
+        seen = collections.defaultdict(set)
+        conflicts = []
         for adapter in self.manila_plugin_adapters:
-            # get the configuration data for all plugins
             config_data = adapter.relation.get_configuration_data()
+            for name in sorted(config_data):
+                for config_file, chunk in sorted(config_data[name].items()):
+                    digest = hashlib.sha256(
+                        chunk.encode('utf-8')).hexdigest()
+                    if digest in seen[config_file]:
+                        continue
+                    if name in index[config_file]:
+                        conflicts.append((config_file, name))
+                        continue
+                    seen[config_file].add(digest)
+                    index[config_file][name] = chunk
+        return index, conflicts
 
-            # make the config_data <config_file>: {<name>: string} format
-            for name, config_files in config_data.items():
-                for file, data in config_files.items():
-                    inverted_config_data[file][name] = data
-        # now see if it's the one we want
-        if config_file not in inverted_config_data:
-            return []
-        for name, chunk in inverted_config_data[config_file].items():
+    def config_lines_for(self, config_file):
+        """Return the list of configuration lines for `config_file` as returned
+        by manila-plugin backend charms; see plugin_config_index.
+
+        :param config_file: string, filename for configuration lines
+        :returns: list of strings: config lines for `config_file`
+        """
+        config_lines = []
+        index, _ = self.plugin_config_index
+        for chunk in index.get(config_file, {}).values():
             config_lines.append(chunk)
             config_lines.append('')
         return config_lines
@@ -466,16 +1338,8 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
 
         :returns: [list of config files]
         """
-
-        config_files = set()
-        for adapter in self.manila_plugin_adapters:
-            # get the configuration data for all plugins
-            config_data = adapter.relation.get_configuration_data()
-
-            for name, data in config_data.items():
-                for config_file in data.keys():
-                    config_files.add(config_file)
-        return list(config_files)
+        index, _ = self.plugin_config_index
+        return list(index.keys())
 
     @property
     def manila_plugin_adapters(self):
@@ -518,8 +1382,60 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
             if check_enabled != 0:
                 subprocess.check_call(['a2ensite',
                                        MANILA_WEBSERVER_SITE])
-                host.service_reload('apache2',
-                                    restart_on_failure=True)
+                self.queue_service_action('apache2', 'reload')
+
+    def enable_apache_modules(self, modules):
+        """Enable the apache2 `modules` that aren't already, and queue an
+        apache2 restart to load them.
+
+        :param modules: list of module names
+        """
+        disabled = [module for module in modules
+                    if subprocess.call(['a2query', '-m', module]) != 0]
+        if disabled:
+            subprocess.check_call(['a2enmod'] + disabled)
+            self.queue_service_action('apache2', 'restart')
+
+    def configure_http2(self):
+        """Enable the apache2 http2 module if 'api-http2' is set with TLS.
+
+        The module is left enabled when the option is unset; the TLS frontend
+        then no longer offers h2.
+        """
+        if not (self.options.api_http2 and self.get_state('ssl.enabled')):
+            return
+        self.enable_apache_modules(['http2'])
+
+    def configure_compression(self):
+        """Enable the apache2 deflate and filter modules if 'api-compression'
+        is set.
+
+        The modules are left enabled when the option is unset; the manila
+        site then no longer uses them.
+        """
+        if not self.options.api_compression:
+            return
+        self.enable_apache_modules(['deflate', 'filter'])
+
+    def configure_version_cache(self):
+        """Set up the cache of the API version documents.
+
+        If 'api-version-cache-ttl' is set, the apache2 cache modules are
+        enabled.  The cache is in shared memory, so apache2 is restarted to
+        empty it when the manila package version changes, as the documents
+        may then differ.
+        """
+        version = fetch.get_installed_version(self.release_pkg)
+        version = version.ver_str if version else None
+        db = unitdata.kv()
+        previous = db.get(VERSION_CACHE_PACKAGE_KEY)
+        db.set(VERSION_CACHE_PACKAGE_KEY, version)
+        if not self.options.api_version_cache_ttl:
+            return
+        self.enable_apache_modules(
+            ['cache', 'cache_socache', 'socache_shmcb', 'headers'])
+        if previous is not None and previous != version:
+            self.queue_service_action('apache2', 'restart')
 
     def render_nrpe_checks(self):
         """Configure Nagios NRPE checks."""
@@ -528,8 +1444,351 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
         charm_nrpe = nrpe.NRPE(hostname=hostname)
         nrpe.add_init_service_checks(
             charm_nrpe, self.services, current_unit)
+        if self.options.metrics_exporter_port:
+            nrpe.add_init_service_checks(
+                charm_nrpe, [MANILA_EXPORTER_SERVICE], current_unit)
+        self.add_api_checks(charm_nrpe)
         charm_nrpe.write()
 
+    def configure_metrics_exporter(self):
+        """Install, update or remove the local Prometheus metrics exporter.
+
+        The exporter is enabled by setting 'metrics-exporter-port'.  A static
+        scrape config for it is written to MANILA_EXPORTER_SCRAPE_CONF so that
+        it can be added to a Prometheus server without a relation.
+        """
+        port = self.options.metrics_exporter_port
+        logs = [MANILA_ACCESS_LOG]
+        if self.options.api_compression:
+            logs.append(MANILA_DEFLATE_LOG)
+        if not port:
+            if os.path.exists(MANILA_EXPORTER_UNIT):
+                host.service_stop(MANILA_EXPORTER_SERVICE)
+                host.service('disable', MANILA_EXPORTER_SERVICE)
+                os.remove(MANILA_EXPORTER_UNIT)
+                subprocess.check_call(['systemctl', 'daemon-reload'])
+                self._set_exporter_log_access(
+                    [MANILA_ACCESS_LOG, MANILA_DEFLATE_LOG], grant=False)
+            if os.path.exists(MANILA_EXPORTER_SCRAPE_CONF):
+                os.remove(MANILA_EXPORTER_SCRAPE_CONF)
+            # record_hook_duration() writes the hook metrics while it exists.
+            if os.path.isdir(MANILA_EXPORTER_DIR):
+                shutil.rmtree(MANILA_EXPORTER_DIR)
+            return
+        fetch.apt_install(fetch.filter_installed_packages(['acl']),
+                          fatal=True)
+        host.adduser(MANILA_EXPORTER_USER, shell='/usr/sbin/nologin',
+                     system_user=True)
+        self._set_exporter_log_access(logs)
+        address = (self.options.metrics_exporter_address or
+                   hookenv.unit_private_ip())
+        changed = False
+        source = os.path.join(hookenv.charm_dir(), 'files',
+                              'manila_exporter.py')
+        if host.file_hash(source) != host.file_hash(MANILA_EXPORTER):
+            shutil.copy2(source, MANILA_EXPORTER)
+            os.chmod(MANILA_EXPORTER, 0o755)
+            changed = True
+        exec_start = ' '.join(
+            ['/usr/bin/python3', MANILA_EXPORTER,
+             '--address', address,
+             '--port', str(port),
+             '--access-log', MANILA_ACCESS_LOG,
+             '--hook-metrics', MANILA_HOOK_METRICS] +
+            (['--compression-log', MANILA_DEFLATE_LOG]
+             if self.options.api_compression else []) +
+            ['--service {}'.format(service) for service in self.services])
+        unit = ('[Unit]\n'
+                'Description=Prometheus exporter for the manila services\n'
+                'After=network.target\n'
+                '\n'
+                '[Service]\n'
+                'ExecStart={}\n'
+                'User={}\n'
+                'NoNewPrivileges=yes\n'
+                'ProtectSystem=strict\n'
+                'ProtectHome=yes\n'
+                'PrivateTmp=yes\n'
+                'Restart=on-failure\n'
+                '\n'
+                '[Install]\n'
+                'WantedBy=multi-user.target\n'
+                .format(exec_start, MANILA_EXPORTER_USER))
+        if (not os.path.exists(MANILA_EXPORTER_UNIT) or
+                host.file_hash(MANILA_EXPORTER_UNIT) !=
+                hashlib.md5(unit.encode('utf-8')).hexdigest()):
+            host.write_file(MANILA_EXPORTER_UNIT, unit.encode('utf-8'),
+                            perms=0o644)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+            changed = True
+        host.mkdir(MANILA_EXPORTER_DIR, perms=0o755)
+        host.mkdir(os.path.dirname(MANILA_EXPORTER_SCRAPE_CONF), perms=0o755)
+        host.write_file(
+            MANILA_EXPORTER_SCRAPE_CONF,
+            ('- job_name: {}\n'
+             '  static_configs:\n'
+             '    - targets: [\'{}:{}\']\n'
+             '      labels:\n'
+             '        juju_unit: {}\n'
+             .format(hookenv.local_unit().replace('/', '-'),
+                     format_host(address), port,
+                     hookenv.local_unit())).encode('utf-8'),
+            perms=0o644)
+        host.service('enable', MANILA_EXPORTER_SERVICE)
+        if changed:
+            self.queue_service_action(MANILA_EXPORTER_SERVICE, 'restart')
+
+    def _set_exporter_log_access(self, logs, grant=True):
+        """Grant, or revoke, the exporter's read access to `logs`.
+
+        The access is given by ACL entries for MANILA_EXPORTER_USER, rather
+        than membership of the adm group, which can read every system log.
+        logrotate copies the ACL of a log to the file it re-creates, and the
+        entries are set again each time the exporter is configured.
+
+        :param logs: paths of logs in the apache2 log directory.
+        :param grant: True to grant read access, False to revoke it.
+        """
+        if grant:
+            subprocess.check_call(
+                ['setfacl', '-m', 'u:{}:x'.format(MANILA_EXPORTER_USER),
+                 os.path.dirname(MANILA_ACCESS_LOG)])
+            for log in logs:
+                if os.path.exists(log):
+                    subprocess.check_call(
+                        ['setfacl', '-m',
+                         'u:{}:r'.format(MANILA_EXPORTER_USER), log])
+            return
+        for path in [os.path.dirname(MANILA_ACCESS_LOG)] + logs:
+            if os.path.exists(path):
+                # fails harmlessly if the entry, or the user, is gone.
+                subprocess.call(
+                    ['setfacl', '-x', 'u:{}'.format(MANILA_EXPORTER_USER),
+                     path])
+
+    @property
+    def resource_controls(self):
+        """Return the 'service-resource-controls' settings for self.services.
+
+        With 'share-service-per-backend', the settings for manila-share apply
+        to each manila-share@<backend> instance, under its own settings.
+
+        :returns: OrderedDict of service: OrderedDict of directive: value
+        :raises ValueError: as parse_resource_controls()
+        """
+        services = self.services
+        instances = [s for s in services if s.startswith('manila-share@')]
+        if instances:
+            services = services + ['manila-share']
+        controls = parse_resource_controls(
+            self.options.service_resource_controls, services)
+        share = controls.pop('manila-share', None) if instances else None
+        if share:
+            for service in instances:
+                settings = share.copy()
+                settings.update(controls.get(service, {}))
+                controls[service] = settings
+        return controls
+
+    def configure_resource_controls(self):
+        """Write the systemd resource control drop-ins for the services.
+
+        Each service with settings in 'service-resource-controls' gets a
+        drop-in; the drop-ins of the others are removed.  Services whose
+        drop-in changes are restarted, as for the files in restart_map.
+        An invalid option is left to custom_assess_status_check().
+        """
+        services = self.services
+        try:
+            controls = self.resource_controls
+        except ValueError:
+            return
+        restart_map = {SYSTEMD_RESOURCE_CONTROLS_CONF.format(service):
+                       [service] for service in services}
+        changed = False
+        with self.restart_on_change(restart_map):
+            for service in services:
+                path = SYSTEMD_RESOURCE_CONTROLS_CONF.format(service)
+                if service not in controls:
+                    if os.path.exists(path):
+                        os.remove(path)
+                        changed = True
+                    continue
+                content = ('# Managed by juju\n[Service]\n' + ''.join(
+                    '{}={}\n'.format(directive, value)
+                    for directive, value in controls[service].items())
+                ).encode('utf-8')
+                if (os.path.exists(path) and host.file_hash(path) ==
+                        hashlib.md5(content).hexdigest()):
+                    continue
+                host.mkdir(os.path.dirname(path), perms=0o755)
+                host.write_file(path, content, perms=0o644)
+                changed = True
+        if changed:
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+
+    def configure_share_instances(self):
+        """Set up the manila-share@<backend> instances, or remove them.
+
+        With 'share-service-per-backend', the packaged manila-share service
+        is stopped and disabled, and an instance is enabled for each local
+        backend.  Instances whose backend has gone are stopped and removed.
+        New or reconfigured instances are queued for a restart, which starts
+        them.  Otherwise manila-share is enabled if there is a local backend.
+
+        :returns: True if any instance was added or removed
+        """
+        wanted = set()
+        if (self.options.share_service_per_backend and
+                self.get_adapter(LOCAL_PLUGIN_RELATION)):
+            wanted = set(self.configured_local_backends)
+        existing = set(
+            os.path.basename(path)[:-len('.conf')]
+            for path in glob.glob(MANILA_SHARE_BACKEND_CONF.format('*')))
+        for backend in sorted(existing - wanted):
+            service = 'manila-share@{}'.format(backend)
+            host.service_stop(service)
+            host.service('disable', service)
+            os.remove(MANILA_SHARE_BACKEND_CONF.format(backend))
+        if not wanted:
+            # back to the single packaged service; it may also have been
+            # left disabled when the instances went with the local backends.
+            if (self.get_adapter(LOCAL_PLUGIN_RELATION) and
+                    (existing or
+                     not host.service('is-enabled', 'manila-share'))):
+                host.service('enable', 'manila-share')
+                self.queue_service_action('manila-share', 'restart')
+            return existing != wanted
+        unit = ('[Unit]\n'
+                'Description=OpenStack Manila Share, backend %i\n'
+                'After=network-online.target\n'
+                '\n'
+                '[Service]\n'
+                'User=manila\n'
+                'Group=manila\n'
+                'ExecStart=/usr/bin/manila-share'
+                ' --config-file={}'
+                ' --config-file={}'
+                ' --log-file=/var/log/manila/manila-share-%i.log\n'
+                'Restart=on-failure\n'
+                '\n'
+                '[Install]\n'
+                'WantedBy=multi-user.target\n'
+                .format(MANILA_CONF, MANILA_SHARE_BACKEND_CONF.format('%i')))
+        if (not os.path.exists(MANILA_SHARE_INSTANCE_UNIT) or
+                host.file_hash(MANILA_SHARE_INSTANCE_UNIT) !=
+                hashlib.md5(unit.encode('utf-8')).hexdigest()):
+            host.write_file(MANILA_SHARE_INSTANCE_UNIT, unit.encode('utf-8'),
+                            perms=0o644)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        if not existing:
+            host.service_stop('manila-share')
+            host.service('disable', 'manila-share')
+        host.mkdir(MANILA_SHARE_BACKEND_DIR, owner='root', group='manila',
+                   perms=0o750)
+        for backend in sorted(wanted):
+            path = MANILA_SHARE_BACKEND_CONF.format(backend)
+            content = ('# Managed by juju\n'
+                       '[DEFAULT]\n'
+                       'enabled_share_backends = {}\n'
+                       .format(backend)).encode('utf-8')
+            if (os.path.exists(path) and
+                    host.file_hash(path) == hashlib.md5(content).hexdigest()):
+                continue
+            host.write_file(path, content, owner='root', group='manila',
+                            perms=0o640)
+            service = 'manila-share@{}'.format(backend)
+            host.service('enable', service)
+            self.queue_service_action(service, 'restart')
+        return existing != wanted
+
+    def configure_profiler(self):
+        """Install the client library for a redis OSProfiler backend."""
+        if (self.options.profiler and
+                self.options.profiler_connection_string.startswith(
+                    PROFILER_REDIS_SCHEMES)):
+            fetch.apt_install(
+                fetch.filter_installed_packages(['python3-redis']),
+                fatal=True)
+
+    def configure_data_mount_location(self):
+        """Create the directory that manila-data mounts shares under for its
+        copies, if 'data-mount-tmp-location' is set.
+
+        An invalid option is left to custom_assess_status_check().
+        """
+        path = self.options.data_mount_tmp_location
+        if path and os.path.isabs(path):
+            host.mkdir(path, owner='manila', group='manila', perms=0o750)
+
+    @property
+    def api_check_host(self):
+        """Return the host that the API versions check connects to.
+
+        The TLS frontend's virtual hosts are bound to the unit's addresses
+        (see openstack_https_frontend.conf), so a request to localhost would
+        not match any of them; with TLS, the first of those addresses is used.
+
+        :returns: a hostname or address, bracketed if IPv6.
+        """
+        if self.get_state('ssl.enabled'):
+            for address, _, _, _ in self.options.endpoints:
+                return format_host(address)
+        return 'localhost'
+
+    def add_api_checks(self, charm_nrpe):
+        """Add the manila API latency and error-rate checks.
+
+        The versions document is fetched (unauthenticated) on each port in
+        api_ports, and the access log is checked for the p95 latency and 5xx
+        rate over 'api-check-window' seconds.
+
+        :param charm_nrpe: the NRPE instance to add the checks to.
+        """
+        nrpe.copy_nrpe_checks(nrpe_files_dir=os.path.join(
+            hookenv.charm_dir(), 'files', 'nagios'))
+        options = self.options
+        access_log_args = ('--log {} --window {} '
+                           '--warn-p95 {} --crit-p95 {} '
+                           '--warn-5xx {} --crit-5xx {}'
+                           .format(MANILA_ACCESS_LOG,
+                                   options.api_check_window,
+                                   options.api_check_p95_warn,
+                                   options.api_check_p95_crit,
+                                   options.api_check_error_rate_warn,
+                                   options.api_check_error_rate_crit))
+        # The apache2 logs are only readable by root and the adm group;
+        # check_manila_api_access_log runs the check through sudo, with
+        # exactly these arguments, rather than giving nagios read access to
+        # every system log.
+        host.write_file(
+            NAGIOS_SUDOERS,
+            '# Managed by juju\n'
+            'nagios ALL=(root) NOPASSWD: {} access-log {}\n'
+            .format(os.path.join(NAGIOS_PLUGINS_DIR, NAGIOS_CHECK_API),
+                    access_log_args).encode('utf-8'),
+            perms=0o440)
+        scheme = 'https' if self.get_state('ssl.enabled') else 'http'
+        api_host = self.api_check_host
+        ports = sorted(set(port
+                           for api_ports in self.api_ports.values()
+                           for port in api_ports.values()))
+        for port in ports:
+            charm_nrpe.add_check(
+                shortname='manila_api_versions_{}'.format(port),
+                description='manila API versions latency on port {}'
+                            .format(port),
+                check_cmd=('{} versions --url {}://{}:{}/ '
+                           '--warn {} --crit {}'
+                           .format(NAGIOS_CHECK_API, scheme, api_host, port,
+                                   options.api_check_latency_warn,
+                                   options.api_check_latency_crit)))
+        charm_nrpe.add_check(
+            shortname='manila_api_access_log',
+            description='manila API p95 latency and 5xx rate',
+            check_cmd='{} {}'.format(NAGIOS_CHECK_API_ACCESS_LOG,
+                                     access_log_args))
+
 
 class ManilaCharmRocky(ManilaCharm):
 
@@ -14,16 +14,90 @@
 
 # this is just for the reactive handlers and calls into the charm.
 
+import contextlib
+import hashlib
+import json
+import time
+
 import charmhelpers.contrib.openstack.utils as os_utils
+import charmhelpers.core.hookenv as hookenv
 import charmhelpers.core.host as ch_host
+import charmhelpers.core.unitdata as unitdata
 
 import charms.reactive
 import charms.reactive.relations as relations
 import charms_openstack.bus
 import charms_openstack.charm
 
+import charm.openstack.manila as manila
+
 charms_openstack.bus.discover()
 
+# unitdata keys used to remember what was last published to the plugins.
+PLUGIN_AUTH_HASH_KEY = 'manila.plugin-auth.hash.{}'
+PLUGIN_AUTH_SUPPRESSED_KEY = 'manila.plugin-auth.suppressed'
+
+# The handlers are loaded at the start of the hook, so this is (near enough)
+# when the hook started.
+_hook_start = time.time()
+
+
+def _record_hook_duration():
+    """Record how long this hook took, and the number of suppressed plugin
+    auth writes, for the metrics exporter.
+    """
+    manila.record_hook_duration(
+        hookenv.hook_name(), time.time() - _hook_start,
+        unitdata.kv().get(PLUGIN_AUTH_SUPPRESSED_KEY, 0))
+
+
+hookenv.atexit(_record_hook_duration)
+
+
+# The charm instance shared by the handlers in this hook invocation, and the
+# value of ManilaCharm.upgrades when it was made.
+_manila_charm = None
+_manila_charm_upgrades = 0
+
+
+@contextlib.contextmanager
+def provide_manila_charm():
+    """Provide the same charm instance to the handlers of this module.
+
+    Each hook is a fresh process, so caching the instance at module level
+    means that the charm class and its adapters are only constructed once per
+    hook for these handlers; the charms.openstack default handlers still
+    make their own.  After an OpenStack upgrade in the
+    hook a new instance is made, as the release class may have changed.
+    """
+    global _manila_charm, _manila_charm_upgrades
+    if (_manila_charm is None or
+            _manila_charm_upgrades != manila.ManilaCharm.upgrades):
+        with charms_openstack.charm.provide_charm_instance() as manila_charm:
+            _manila_charm = manila_charm
+            _manila_charm_upgrades = manila.ManilaCharm.upgrades
+    yield _manila_charm
+
+
+def _run_pending_restarts():
+    """Run the restarts that were queued while the unit was paused."""
+    with provide_manila_charm() as manila_charm:
+        manila_charm.run_pending_restarts()
+
+
+def _replay_pending_restarts():
+    """Run the restarts left queued by earlier hooks at the end of this one.
+
+    Restarts queued while the unit is paused are kept in unitdata; without
+    this they would only be run once a later hook queued another one.
+    """
+    if (unitdata.kv().get(manila.PENDING_RESTARTS_KEY) and
+            not os_utils.is_unit_paused_set()):
+        hookenv.atexit(_run_pending_restarts)
+
+
+_replay_pending_restarts()
+
 
 # Use the charms.openstack defaults for common states and hooks
 charms_openstack.charm.use_defaults(
@@ -49,7 +123,7 @@ def register_endpoints(keystone):
     as it needs to register multiple endpoints, and thus needs a custom
     function in the charm.
     """
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with provide_manila_charm() as manila_charm:
         manila_charm.register_endpoints(keystone)
         manila_charm.assess_status()
 
@@ -86,22 +160,37 @@ def share_to_manila_plugins_auth():
                              port=keystone.auth_port())),
         'auth_type': 'password',
     }
-    # Set the auth data to be the same for all plugins
+    # Set the auth data to be the same for all plugins, but only write it to
+    # the relation if it has changed since it was last published; each write
+    # triggers a relation-changed hook on every remote plugin unit.  The
+    # hashes are committed by charms.reactive with the rest of the unitdata,
+    # and so only if the hook (and thus the relation write) succeeds.
+    data_hash = hashlib.sha256(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+    db = unitdata.kv()
     for manila_plugin in manila_plugins:
-        if manila_plugin is not None:
-            manila_plugin.set_authentication_data(data)
+        if manila_plugin is None:
+            continue
+        keys = [PLUGIN_AUTH_HASH_KEY.format(relation.relation_id)
+                for relation in manila_plugin.relations]
+        if all(db.get(key) == data_hash for key in keys):
+            db.set(PLUGIN_AUTH_SUPPRESSED_KEY,
+                   db.get(PLUGIN_AUTH_SUPPRESSED_KEY, 0) + 1)
+            continue
+        manila_plugin.set_authentication_data(data)
+        for key in keys:
+            db.set(key, data_hash)
 
 
 @charms.reactive.when('shared-db.available',
                       'manila.config.rendered')
 def maybe_do_syncdb(shared_db):
-    """Sync the database when the shared-db becomes available.  Note that the
-    charms.openstack.OpenStackCharm.db_sync() default method checks that only
-    the leader does the sync.  As manila uses alembic to do the database
-    migration, it doesn't matter if it's done more than once, so we don't have
-    to gate it in the charm.
+    """Sync the database when the shared-db becomes available.  Note that
+    ManilaCharm.db_sync() checks that only the leader does the sync, and skips
+    it if the package version and alembic head are unchanged since the last
+    sync.  The 'db-sync' action can be used to force a resync.
     """
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with provide_manila_charm() as manila_charm:
         manila_charm.db_sync()
     charms.reactive.set_state('db.synced')
 
@@ -117,7 +206,7 @@ def render_stuff(*args):
     get the config, so we unconditionally clear the changed status here, if it
     was set.
     """
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with provide_manila_charm() as manila_charm:
         pre_ssl_enabled = manila_charm.get_state('ssl.enabled')
         tls = relations.endpoint_from_flag('certificates.available')
         manila_charm.configure_tls(certificates_interface=tls)
@@ -125,8 +214,20 @@ def render_stuff(*args):
             keystone = relations.endpoint_from_flag(
                 'identity-service.available')
             manila_charm.register_endpoints(keystone)
+        manila_charm.configure_http2()
+        manila_charm.configure_compression()
+        manila_charm.configure_version_cache()
+        manila_charm.configure_data_mount_location()
 
         manila_charm.render_with_interfaces(args)
+        manila_charm.configure_purge_cron()
+        manila_charm.configure_metrics_exporter()
+        manila_charm.configure_profiler()
+        if (manila_charm.configure_share_instances() and
+                charms.reactive.is_state('nrpe-external-master.available')):
+            # cover the added or removed manila-share@<backend> instances.
+            manila_charm.render_nrpe_checks()
+        manila_charm.configure_resource_controls()
         manila_charm.assess_status()
         charms.reactive.set_state('manila.config.rendered')
         for manila_plugin in [
@@ -165,19 +266,23 @@ def update_status():
 
     Note, there is no need to actually call update_status as one of the other
     handlers will activate it.
+
+    With 'share-service-per-backend', this covers each manila-share@<backend>
+    instance.
     """
     if not os_utils.is_unit_paused_set():
-        with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        with provide_manila_charm() as manila_charm:
             if manila_charm.get_adapter('manila-plugin.connected'):
-                services = ['manila-share']
+                services = manila_charm.share_services
             else:
                 services = []
         state, message = os_utils._ows_check_services_running(
             services=services,
             ports=None)
         if state == 'blocked' and services:
-            # try to start the 'manila-share' service
-            ch_host.service_start('manila-share')
+            # try to start the manila-share service(s)
+            for service in services:
+                ch_host.service_start(service)
 
 
 @charms.reactive.when('db.synced', 'manila.config.rendered')
@@ -196,10 +301,19 @@ def config_rendered():
     charms.reactive.set_state('config.rendered')
 
 
+@charms.reactive.when('cluster.connected')
+def publish_api_capacity(*args):
+    """Share this unit's API capacity with its peers so that they can weight
+    its haproxy backend accordingly.
+    """
+    with provide_manila_charm() as manila_charm:
+        manila_charm.publish_api_capacity()
+
+
 @charms.reactive.when('ha.connected')
 def cluster_connected(hacluster):
     """Configure HA resources in corosync"""
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with provide_manila_charm() as manila_charm:
         manila_charm.configure_ha_resources(hacluster)
         manila_charm.assess_status()
 
@@ -208,9 +322,24 @@ def cluster_connected(hacluster):
 @charms.reactive.when('config.rendered')
 @charms.reactive.when_any('config.changed.nagios_context',
                           'config.changed.nagios_servicegroups',
+                          'config.changed.api-check-latency-warn',
+                          'config.changed.api-check-latency-crit',
+                          'config.changed.api-check-window',
+                          'config.changed.api-check-p95-warn',
+                          'config.changed.api-check-p95-crit',
+                          'config.changed.api-check-error-rate-warn',
+                          'config.changed.api-check-error-rate-crit',
+                          'config.changed.metrics-exporter-port',
+                          'config.changed.share-service-per-backend',
                           'endpoint.nrpe-external-master.changed',
                           'nrpe-external-master.available')
 def configure_nrpe():
     """Handle config-changed for NRPE options."""
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with provide_manila_charm() as manila_charm:
         manila_charm.render_nrpe_checks()
+
+
+@charms.reactive.when_not('nrpe-external-master.available')
+def remove_nrpe_sudoers():
+    """Remove the access log check's sudoers rule once NRPE has gone."""
+    manila.remove_nagios_sudoers()
@@ -17,6 +17,9 @@ import sys
 
 sys.path.append('src')
 sys.path.append('src/lib')
+sys.path.append('src/actions')
+sys.path.append('src/files')
+sys.path.append('src/files/nagios')
 
 # Mock out charmhelpers so that we can test without it.
 import charms_openstack.test_mocks  # noqa
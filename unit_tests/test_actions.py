@@ -0,0 +1,159 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+from unittest import mock
+
+import actions
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestManilaActions(test_utils.PatchHelper):
+
+    def _patch_provide_charm_instance(self):
+        manila_charm = mock.MagicMock()
+        self.patch('charms_openstack.charm.provide_charm_instance',
+                   name='provide_charm_instance',
+                   new=mock.MagicMock())
+        self.provide_charm_instance().__enter__.return_value = manila_charm
+        self.provide_charm_instance().__exit__.return_value = None
+        return manila_charm
+
+    def test_main_unknown_action(self):
+        self.assertEqual(actions.main(['/path/to/unknown']),
+                         "Action unknown undefined")
+
+    def test_main_action_fails(self):
+        self.patch_object(actions.hookenv, 'action_fail')
+        with mock.patch.dict(actions.ACTIONS,
+                             {'db-sync': mock.Mock(side_effect=Exception(
+                                 'boom'))}):
+            self.patch_object(actions.hookenv, '_run_atexit')
+        actions.main(['db-sync'])
+        self.action_fail.assert_called_once_with('boom')
+        self._run_atexit.assert_not_called()
+
+    def test_main_runs_deferred_callbacks(self):
+        self.patch_object(actions.hookenv, '_run_atexit')
+        action = mock.Mock()
+        with mock.patch.dict(actions.ACTIONS, {'db-sync': action}):
+            actions.main(['/path/to/db-sync'])
+        action.assert_called_once_with(['/path/to/db-sync'])
+        self._run_atexit.assert_called_once_with()
+
+    def test_db_sync(self):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.db_sync_marker.return_value = '1:abc'
+        self.patch_object(actions.hookenv, 'is_leader', return_value=True)
+        self.patch_object(actions.hookenv, 'action_set')
+        actions.db_sync()
+        manila_charm.db_sync.assert_called_once_with(force=True)
+        self.action_set.assert_called_once_with({'marker': '1:abc'})
+
+    def test_db_sync_not_leader(self):
+        manila_charm = self._patch_provide_charm_instance()
+        self.patch_object(actions.hookenv, 'is_leader', return_value=False)
+        self.patch_object(actions.hookenv, 'action_fail')
+        actions.db_sync()
+        manila_charm.db_sync.assert_not_called()
+        self.action_fail.assert_called_once_with(mock.ANY)
+
+    def _patch_openstack_upgrade(self, managed=True, available=True):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.openstack_upgrade_available.return_value = available
+        self.patch_object(actions.hookenv, 'config',
+                          return_value=managed)
+        self.patch_object(actions.relations, 'endpoint_from_flag',
+                          side_effect=lambda flag: flag)
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.hookenv, 'action_fail')
+        return manila_charm
+
+    def test_openstack_upgrade(self):
+        manila_charm = self._patch_openstack_upgrade()
+        manila_charm.run_upgrade.return_value = collections.OrderedDict([
+            ('fetch', 61.234), ('install', 12.5)])
+        actions.openstack_upgrade()
+        manila_charm.run_upgrade.assert_called_once_with(
+            interfaces_list=list(actions.UPGRADE_INTERFACE_FLAGS))
+        self.action_set.assert_called_once_with({
+            'outcome': 'success',
+            'timings.fetch': '61.23',
+            'timings.install': '12.50'})
+
+    def test_openstack_upgrade_not_available(self):
+        manila_charm = self._patch_openstack_upgrade(available=False)
+        actions.openstack_upgrade()
+        manila_charm.run_upgrade.assert_not_called()
+        self.action_set.assert_called_once_with(
+            {'outcome': 'no upgrade available'})
+
+    def test_openstack_upgrade_not_action_managed(self):
+        manila_charm = self._patch_openstack_upgrade(managed=False)
+        actions.openstack_upgrade()
+        manila_charm.run_upgrade.assert_not_called()
+        self.action_fail.assert_called_once_with(mock.ANY)
+
+    def test_purge_deleted_rows(self):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.purge_deleted_rows.return_value = (12, 1.234)
+        self.patch_object(actions.hookenv, 'is_leader', return_value=True)
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=lambda k: {'age': 7,
+                                                 'dry-run': False}[k])
+        self.patch_object(actions.hookenv, 'action_set')
+        actions.purge_deleted_rows()
+        manila_charm.purge_deleted_rows.assert_called_once_with(7)
+        self.action_set.assert_called_once_with(
+            {'rows-removed': 12, 'elapsed-seconds': '1.23'})
+        manila_charm.purge_deleted_rows.return_value = (None, 1.234)
+        self.action_set.reset_mock()
+        actions.purge_deleted_rows()
+        self.action_set.assert_called_once_with(
+            {'rows-removed': 'unknown', 'elapsed-seconds': '1.23'})
+
+    def test_purge_deleted_rows_dry_run(self):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.purge_cmd = ['sudo', 'manila-manage', 'db', 'purge']
+        manila_charm.options.purge_deleted_rows_age = 30
+        self.patch_object(actions.hookenv, 'is_leader', return_value=True)
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=lambda k: {'age': None,
+                                                 'dry-run': True}[k])
+        self.patch_object(actions.hookenv, 'action_set')
+        actions.purge_deleted_rows()
+        manila_charm.purge_deleted_rows.assert_not_called()
+        self.action_set.assert_called_once_with(
+            {'command': 'sudo manila-manage db purge 30', 'cutoff': mock.ANY})
+
+    def test_restart_pending_services(self):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.run_pending_restarts.return_value = [
+            ('manila-data', 'restart'), ('apache2', 'reload')]
+        self.patch_object(actions.os_utils, 'is_unit_paused_set',
+                          return_value=False)
+        self.patch_object(actions.hookenv, 'action_set')
+        actions.restart_pending_services()
+        self.action_set.assert_called_once_with(
+            {'services': 'manila-data:restart apache2:reload'})
+
+    def test_restart_pending_services_paused(self):
+        manila_charm = self._patch_provide_charm_instance()
+        self.patch_object(actions.os_utils, 'is_unit_paused_set',
+                          return_value=True)
+        self.patch_object(actions.hookenv, 'action_fail')
+        actions.restart_pending_services()
+        manila_charm.run_pending_restarts.assert_not_called()
+        self.action_fail.assert_called_once_with(mock.ANY)
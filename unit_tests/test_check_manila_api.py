@@ -0,0 +1,145 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import http.server
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import check_manila_api
+
+
+class _VersionsHandler(http.server.BaseHTTPRequestHandler):
+
+    delay = 0
+    code = 300
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = b'{"versions": []}'
+        self.send_response(self.code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCheckVersions(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = http.server.HTTPServer(('127.0.0.1', 0),
+                                             _VersionsHandler)
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(setattr, _VersionsHandler, 'delay', 0)
+        self.addCleanup(setattr, _VersionsHandler, 'code', 300)
+
+    def test_ok(self):
+        status, message = check_manila_api.check_versions(
+            self.url, 1000, 5000)
+        self.assertEqual(status, check_manila_api.OK)
+        self.assertIn('returned 300', message)
+
+    def test_slow(self):
+        _VersionsHandler.delay = 0.2
+        status, _ = check_manila_api.check_versions(self.url, 100, 5000)
+        self.assertEqual(status, check_manila_api.WARNING)
+        status, _ = check_manila_api.check_versions(self.url, 50, 100)
+        self.assertEqual(status, check_manila_api.CRITICAL)
+
+    def test_server_error(self):
+        _VersionsHandler.code = 503
+        status, message = check_manila_api.check_versions(
+            self.url, 1000, 5000)
+        self.assertEqual(status, check_manila_api.CRITICAL)
+        self.assertIn('503', message)
+
+    def test_unreachable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        status, _ = check_manila_api.check_versions(
+            self.url, 1000, 5000, timeout=1)
+        self.assertEqual(status, check_manila_api.CRITICAL)
+
+
+class TestCheckAccessLog(unittest.TestCase):
+
+    NOW = datetime.datetime(2026, 10, 19, 12, 0, 0,
+                            tzinfo=datetime.timezone.utc)
+
+    def _line(self, seconds_ago, status, usecs):
+        when = self.NOW - datetime.timedelta(seconds=seconds_ago)
+        return ('10.0.0.1 - - [{}] "GET /v2/shares/detail HTTP/1.1" {} 1234 '
+                '"-" "python-manilaclient" {}'
+                .format(when.strftime('%d/%b/%Y:%H:%M:%S %z'), status, usecs))
+
+    def _write_log(self, lines):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_access_log_stats(self):
+        lines = [self._line(10, 200, (i + 1) * 1000) for i in range(100)]
+        # outside the window, so ignored.
+        lines.append(self._line(600, 500, 10 ** 9))
+        lines.append('garbage')
+        count, p95, error_rate = check_manila_api.access_log_stats(
+            lines, 300, now=self.NOW)
+        self.assertEqual(count, 100)
+        self.assertEqual(p95, 95.0)
+        self.assertEqual(error_rate, 0.0)
+
+    def test_check_access_log(self):
+        lines = ([self._line(10, 200, 1000)] * 90 +
+                 [self._line(10, 503, 3000000)] * 10)
+        path = self._write_log(lines)
+        status, message = check_manila_api.check_access_log(
+            path, 300, 2000, 5000, 5, 20, now=self.NOW)
+        self.assertEqual(status, check_manila_api.WARNING)
+        self.assertIn('5xx 10.0%', message)
+        status, _ = check_manila_api.check_access_log(
+            path, 300, 5000, 10000, 50, 80, now=self.NOW)
+        self.assertEqual(status, check_manila_api.OK)
+
+    def test_check_access_log_no_requests(self):
+        path = self._write_log([self._line(600, 200, 1000)])
+        status, _ = check_manila_api.check_access_log(
+            path, 300, 2000, 5000, 5, 20, now=self.NOW)
+        self.assertEqual(status, check_manila_api.OK)
+
+    def test_check_access_log_missing(self):
+        status, _ = check_manila_api.check_access_log(
+            '/nonexistent/manila_access.log', 300, 2000, 5000, 5, 20)
+        self.assertEqual(status, check_manila_api.UNKNOWN)
+
+    def test_read_tail(self):
+        path = self._write_log(['first line', 'second', 'third'])
+        self.assertEqual(check_manila_api.read_tail(path, 13),
+                         ['second', 'third'])
+        self.assertEqual(check_manila_api.read_tail(path, 12), ['third'])
+        self.assertEqual(check_manila_api.read_tail(path, 1000),
+                         ['first line', 'second', 'third'])
@@ -0,0 +1,326 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import http.server
+import itertools
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+import urllib.error
+import urllib.request
+
+import jinja2
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'src', 'templates')
+# The overload benchmark: a backend that takes SERVICE_TIME per request and
+# that haproxy passes SERVER_MAXCONN requests at a time, loaded by CLIENTS
+# concurrent clients each making REQUESTS requests in turn.
+SERVICE_TIME = 0.1
+SERVER_MAXCONN = 2
+CLIENTS = 40
+REQUESTS = 5
+
+
+def _cluster(backends):
+    return types.SimpleNamespace(cluster_hosts={
+        '10.0.0.10': {'network': '10.0.0.10/255.255.255.0',
+                      'backends': backends}})
+
+
+def _render(cluster=None, **options):
+    defaults = {
+        'computed_haproxy_maxconn': 20000,
+        'computed_haproxy_server_maxconn': collections.defaultdict(
+            lambda: 8),
+        'computed_haproxy_weights': collections.defaultdict(lambda: 100),
+        'computed_haproxy_http_mode': False,
+        'computed_haproxy_client_key': 'src',
+        'haproxy_queue_timeout': None,
+        'haproxy_connect_timeout': None,
+        'haproxy_client_timeout': None,
+        'haproxy_server_timeout': None,
+        'haproxy_check_interval': 2000,
+        'haproxy_balance': 'leastconn',
+        'haproxy_stat_port': 8888,
+        'haproxy_stat_password': 'secret',
+        'local_address': '10.0.0.10',
+        'service_listen_info': {
+            'manila_api': {'public_port': 8786, 'private_port': 8766}},
+        'api_rate_limit': 0,
+        'api_rate_limit_period': 10,
+        'api_client_max_connections': 0,
+        'api_max_queue': 0,
+    }
+    defaults.update(options)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES))
+    return env.get_template('haproxy.cfg').render(
+        options=types.SimpleNamespace(**defaults), cluster=cluster)
+
+
+class TestHAProxyCfg(unittest.TestCase):
+
+    def test_timeouts_default(self):
+        # unset options fall back to the defaults of the layer template.
+        conf = _render()
+        self.assertIn('    timeout queue 9000\n'
+                      '    timeout connect 9000\n'
+                      '    timeout client 90000\n'
+                      '    timeout server 90000\n'
+                      '    default-server inter 2000\n', conf)
+
+    def test_timeouts(self):
+        conf = _render(haproxy_queue_timeout=1000,
+                       haproxy_connect_timeout=2000,
+                       haproxy_client_timeout=3000,
+                       haproxy_server_timeout=4000)
+        self.assertIn('    timeout queue 1000\n'
+                      '    timeout connect 2000\n'
+                      '    timeout client 3000\n'
+                      '    timeout server 4000\n', conf)
+
+    def test_no_cluster(self):
+        conf = _render()
+        self.assertIn('    maxconn 20000\n', conf)
+        self.assertIn('    bind 10.0.0.10:8888\n', conf)
+        self.assertNotIn('frontend', conf)
+        self.assertNotIn('backend', conf)
+
+    def test_cluster(self):
+        weights = collections.defaultdict(lambda: 100, {'manila-1': 50})
+        maxconn = collections.defaultdict(lambda: 8, {'manila-1': 4})
+        conf = _render(
+            cluster=_cluster(collections.OrderedDict([
+                ('manila-0', '10.0.0.10'), ('manila-1', '10.0.0.11')])),
+            computed_haproxy_weights=weights,
+            computed_haproxy_server_maxconn=maxconn,
+            computed_haproxy_maxconn=4000,
+            haproxy_balance='roundrobin')
+        self.assertIn(
+            'frontend tcp-in_manila_api\n'
+            '    bind *:8786\n'
+            '    maxconn 4000\n'
+            '    acl net_10.0.0.10 dst 10.0.0.10/255.255.255.0\n'
+            '    use_backend manila_api_10.0.0.10 if net_10.0.0.10\n'
+            '    default_backend manila_api_10.0.0.10\n', conf)
+        self.assertIn(
+            'backend manila_api_10.0.0.10\n'
+            '    balance roundrobin\n'
+            '    server manila-0 10.0.0.10:8766 check maxconn 8 weight 100\n'
+            '    server manila-1 10.0.0.11:8766 check maxconn 4 weight 50\n',
+            conf)
+        self.assertNotIn('mode http', conf.split('frontend')[1])
+
+    def test_cluster_no_server_maxconn(self):
+        conf = _render(cluster=_cluster({'manila-0': '10.0.0.10'}),
+                       computed_haproxy_server_maxconn=collections.defaultdict(
+                           lambda: None))
+        self.assertIn('    server manila-0 10.0.0.10:8766 check weight 100\n',
+                      conf)
+
+    def test_admission_control(self):
+        for rate, conns, queue, key in itertools.product(
+                (0, 50), (0, 4), (0, 16),
+                ('src', 'req.hdr_ip(X-Forwarded-For,-1)')):
+            http_mode = bool(rate or conns or queue)
+            conf = _render(
+                cluster=_cluster({'manila-0': '10.0.0.10'}),
+                api_rate_limit=rate,
+                api_client_max_connections=conns,
+                api_max_queue=queue,
+                computed_haproxy_http_mode=http_mode,
+                computed_haproxy_client_key=key)
+            frontend, backend = conf.split('\nfrontend ')[1].split(
+                '\nbackend ')
+            msg = 'rate={} conns={} queue={} key={}'.format(rate, conns,
+                                                            queue, key)
+            self.assertEqual('    mode http\n' in frontend, http_mode, msg)
+            self.assertEqual('    mode http\n' in backend, http_mode, msg)
+            self.assertEqual(
+                '    stick-table type ip size 100k expire 20s '
+                'store http_req_rate(10s),conn_cur\n'
+                '    http-request track-sc0 {}\n'.format(key) in frontend,
+                http_mode, msg)
+            self.assertEqual(
+                '    http-request deny deny_status 429 if '
+                '{ sc_http_req_rate(0) gt 50 }\n' in frontend,
+                bool(rate), msg)
+            self.assertEqual(
+                '    http-request deny deny_status 429 if '
+                '{ sc_conn_cur(0) gt 4 }\n' in frontend,
+                bool(conns), msg)
+            self.assertEqual(
+                '    http-request deny deny_status 429 if '
+                '{ queue gt 16 }\n' in backend,
+                bool(queue), msg)
+            self.assertEqual(conf.count('http-request deny'),
+                             bool(rate) + bool(conns) + bool(queue), msg)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class _SlowHandler(http.server.BaseHTTPRequestHandler):
+    """A stand-in manila-api worker that takes SERVICE_TIME per request."""
+
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        time.sleep(SERVICE_TIME)
+        body = b'{"versions": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _load(url):
+    """Run the benchmark load against `url`.
+
+    :returns: list of (status, seconds) for every request.
+    """
+    results = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(REQUESTS):
+            start = time.time()
+            try:
+                with urllib.request.urlopen(url, timeout=60) as response:
+                    response.read()
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            with lock:
+                results.append((status, time.time() - start))
+
+    threads = [threading.Thread(target=client) for _ in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def _p95(latencies):
+    latencies = sorted(latencies)
+    return latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def benchmark(**options):
+    """Run haproxy, with the charm's config, in front of a slow backend and
+    overload it.
+
+    :param options: template options, e.g. api_max_queue.
+    :returns: dict with the number of 200 and 429 responses and the p95
+        latency, in seconds, of each.
+    """
+    backend = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _SlowHandler)
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    port = _free_port()
+    options.setdefault('computed_haproxy_http_mode', any(
+        options.get(key) for key in ('api_rate_limit',
+                                     'api_client_max_connections',
+                                     'api_max_queue')))
+    conf = _render(
+        cluster=types.SimpleNamespace(cluster_hosts={
+            '127.0.0.1': {'network': '127.0.0.0/255.0.0.0',
+                          'backends': {'manila-0': '127.0.0.1'}}}),
+        local_address='127.0.0.1',
+        haproxy_stat_port=_free_port(),
+        service_listen_info={'manila_api': {
+            'public_port': port,
+            'private_port': backend.server_address[1]}},
+        computed_haproxy_maxconn=1000,
+        computed_haproxy_server_maxconn=collections.defaultdict(
+            lambda: SERVER_MAXCONN),
+        **options)
+    # drop the settings that need root, or the packaged directories.
+    conf = '\n'.join(
+        line for line in conf.splitlines()
+        if not line.strip().startswith(('log /', 'user ', 'group ',
+                                        'stats socket')))
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'haproxy.cfg')
+    with open(path, 'w') as f:
+        f.write(conf + '\n')
+    haproxy = subprocess.Popen([shutil.which('haproxy'), '-db', '-f', path],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                if time.time() > deadline or haproxy.poll() is not None:
+                    raise RuntimeError('haproxy did not start')
+                time.sleep(0.05)
+        results = _load('http://127.0.0.1:{}/'.format(port))
+    finally:
+        haproxy.terminate()
+        haproxy.wait()
+        backend.shutdown()
+        backend.server_close()
+        shutil.rmtree(tmp)
+    stats = {}
+    for status in (200, 429):
+        latencies = [seconds for s, seconds in results if s == status]
+        stats[status] = (len(latencies),
+                         _p95(latencies) if latencies else None)
+    return stats
+
+
+@unittest.skipUnless(shutil.which('haproxy'), 'haproxy is not installed')
+class TestAdmissionControlBenchmark(unittest.TestCase):
+
+    def test_max_queue_bounds_latency(self):
+        unbounded = benchmark()
+        bounded = benchmark(api_max_queue=4)
+        self.assertEqual(unbounded[429][0], 0)
+        self.assertGreater(bounded[429][0], 0)
+        # a request waits behind at most api_max_queue others, served
+        # SERVER_MAXCONN at a time, plus its own service time.
+        bound = (4 / SERVER_MAXCONN + 1) * SERVICE_TIME
+        self.assertLess(bounded[200][1], bound * 2)
+        self.assertLess(bounded[429][1], SERVICE_TIME)
+        self.assertGreater(unbounded[200][1], bounded[200][1] * 2)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['bench']:
+        for options in ({}, {'api_max_queue': 4}):
+            stats = benchmark(**options)
+            print('{!r:>22}: {} x 200 (p95 {:.3f}s), {} x 429 (p95 {})'
+                  .format(options, stats[200][0], stats[200][1] or 0,
+                          stats[429][0],
+                          '{:.3f}s'.format(stats[429][1])
+                          if stats[429][1] is not None else '-'))
+    else:
+        unittest.main()
@@ -44,6 +44,76 @@ class TestManilaCharmUtilities(Helper):
         for (t, r) in tests2:
             self.assertEqual(r, manila.strip_join(t, divider=", "))
 
+    def test_immutable_config_hash(self):
+        self.patch_object(manila.os.path, 'exists', return_value=True)
+        self.assertIsNone(manila.immutable_config_hash('/etc/other.conf'))
+
+        def _hash(data):
+            with mock.patch('builtins.open', mock.mock_open(read_data=data)):
+                return manila.immutable_config_hash(manila.MANILA_CONF)
+
+        debug_on = _hash("[DEFAULT]\ndebug = True\n")
+        debug_off = _hash("[DEFAULT]\ndebug = False\n")
+        other = _hash("[DEFAULT]\nfoo = bar\n")
+        self.assertEqual(debug_on, debug_off)
+        self.assertNotEqual(debug_on, other)
+
+    def test_parse_log_level_overrides(self):
+        self.assertEqual(manila.parse_log_level_overrides(""), {})
+        self.assertEqual(
+            list(manila.parse_log_level_overrides(
+                "sqlalchemy=warn, oslo.messaging=ERROR").items()),
+            [('sqlalchemy', 'WARN'), ('oslo.messaging', 'ERROR')])
+        with self.assertRaises(ValueError):
+            manila.parse_log_level_overrides("sqlalchemy")
+        with self.assertRaises(ValueError):
+            manila.parse_log_level_overrides("sqlalchemy=LOUD")
+
+    def test_parse_cron_schedule(self):
+        self.assertEqual(manila.parse_cron_schedule(""), "")
+        self.assertEqual(manila.parse_cron_schedule(" 0  3 * * sun "),
+                         "0 3 * * sun")
+        self.assertEqual(manila.parse_cron_schedule("*/15 1-5 1,15 * *"),
+                         "*/15 1-5 1,15 * *")
+        for schedule in ("0 3 * *",
+                         "0 3 * * 0 root",
+                         "0 3 * * 0\n* * * * * root /bin/sh",
+                         "0 3 *\n* 0",
+                         "0 3 * * $(id)"):
+            with self.assertRaises(ValueError):
+                manila.parse_cron_schedule(schedule)
+
+    def test_parse_resource_controls(self):
+        services = ['apache2', 'manila-data']
+        self.assertEqual(manila.parse_resource_controls("", services), {})
+        self.assertEqual(
+            manila.parse_resource_controls(
+                "manila-data:CPUWeight=20 manila-data:CPUQuota=200% "
+                "apache2:CPUAffinity=0-3", services),
+            {'manila-data': {'CPUWeight': '20', 'CPUQuota': '200%'},
+             'apache2': {'CPUAffinity': '0-3'}})
+        with self.assertRaises(ValueError):
+            manila.parse_resource_controls("manila-data:CPUWeight", services)
+        with self.assertRaises(ValueError):
+            manila.parse_resource_controls("manila-data:Nice=5", services)
+        with self.assertRaises(ValueError):
+            manila.parse_resource_controls("manila-share:CPUWeight=5",
+                                           services)
+
+    def test_record_hook_duration(self):
+        self.patch_object(manila.os.path, 'isdir', return_value=False)
+        self.patch_object(manila.host, 'write_file')
+        manila.record_hook_duration('config-changed', 1.5)
+        self.write_file.assert_not_called()
+        self.isdir.return_value = True
+        self.patch_object(manila.time, 'time', return_value=100.0)
+        manila.record_hook_duration('config-changed', 1.5, 3)
+        self.write_file.assert_called_once_with(
+            manila.MANILA_HOOK_METRICS,
+            b'{"hook": "config-changed", "duration": 1.5, '
+            b'"timestamp": 100.0, "plugin_auth_suppressed": 3}',
+            perms=0o644)
+
 
 class TestManilaCharmConfigProperties(Helper):
 
@@ -79,6 +149,127 @@ class TestManilaCharmConfigProperties(Helper):
         config.verbose = True
         self.assertEqual(manila.computed_debug_level(config), "DEBUG")
 
+    def test_computed_wsgi_capacity(self):
+        config = mock.MagicMock()
+        config.wsgi_worker_context = {'processes': 4, 'threads': 2}
+        self.assertEqual(manila.computed_wsgi_capacity(config), 8)
+        config.wsgi_worker_context = {'processes': 4}
+        self.assertEqual(manila.computed_wsgi_capacity(config), 4)
+
+    def test_effective_api_capacity(self):
+        self.assertEqual(manila.effective_api_capacity(4, 1, 8), 4)
+        self.assertEqual(manila.effective_api_capacity(8, 2, 4), 8)
+        self.assertEqual(manila.effective_api_capacity(4, 1, None), 4)
+
+    def test_local_api_capacity(self):
+        config = mock.MagicMock()
+        config.wsgi_worker_context = {'processes': 8, 'threads': 2}
+        self.patch_object(manila.os, 'sched_getaffinity',
+                          return_value=set(range(4)))
+        self.assertEqual(manila.local_api_capacity(config), 8)
+
+    def test_computed_haproxy_weights(self):
+        config = mock.MagicMock()
+        config.wsgi_worker_context = {'processes': 8, 'threads': 1}
+        self.patch_object(manila.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(manila.hookenv, 'related_units',
+                          return_value=['manila/1', 'manila/2'])
+        self.patch_object(manila.hookenv, 'local_unit',
+                          return_value='manila/0')
+        self.patch_object(manila.os, 'sched_getaffinity',
+                          return_value=set(range(16)))
+        data = {'manila/1': '2', 'manila/2': None}
+        self.patch_object(manila.hookenv, 'relation_get',
+                          side_effect=lambda k, u, r: data[u])
+        weights = manila.computed_haproxy_weights(config)
+        self.assertEqual(weights['manila-0'], 100)
+        self.assertEqual(weights['manila-1'], 25)
+        # no capacity published
+        self.assertEqual(weights['manila-2'], 100)
+        data['manila/1'] = None
+        weights = manila.computed_haproxy_weights(config)
+        self.assertEqual(weights['manila-1'], 100)
+
+    def test_computed_haproxy_server_maxconn(self):
+        config = mock.MagicMock()
+        config.wsgi_worker_context = {'processes': 4, 'threads': 1}
+        config.haproxy_server_maxconn = 0
+        config.api_rate_limit = 0
+        config.api_client_max_connections = 0
+        config.api_max_queue = 0
+        self.patch_object(manila.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(manila.hookenv, 'related_units',
+                          return_value=['manila/1', 'manila/2'])
+        self.patch_object(manila.hookenv, 'local_unit',
+                          return_value='manila/0')
+        data = {'manila/1': '16', 'manila/2': None}
+        self.patch_object(manila.hookenv, 'relation_get',
+                          side_effect=lambda k, u, r: data[u])
+        # unlimited in TCP mode, where idle connections would hold slots.
+        maxconn = manila.computed_haproxy_server_maxconn(config)
+        self.assertIsNone(maxconn['manila-0'])
+        self.assertIsNone(maxconn['manila-1'])
+        # each unit's own capacity in HTTP mode.
+        config.api_max_queue = 16
+        maxconn = manila.computed_haproxy_server_maxconn(config)
+        self.assertEqual(maxconn['manila-0'], 4)
+        self.assertEqual(maxconn['manila-1'], 16)
+        self.relation_get.assert_called_with('wsgi-capacity', 'manila/2',
+                                             'cluster:1')
+        # no capacity published
+        self.assertIsNone(maxconn['manila-2'])
+        config.haproxy_server_maxconn = 32
+        maxconn = manila.computed_haproxy_server_maxconn(config)
+        self.assertEqual(maxconn['manila-0'], 32)
+        self.assertEqual(maxconn['manila-1'], 32)
+        self.assertEqual(maxconn['manila-2'], 32)
+
+    def test_computed_haproxy_maxconn(self):
+        config = mock.MagicMock()
+        config.haproxy_maxconn = 0
+        self.assertEqual(manila.computed_haproxy_maxconn(config), 20000)
+        config.haproxy_maxconn = 500
+        self.assertEqual(manila.computed_haproxy_maxconn(config), 500)
+
+    def test_computed_haproxy_http_mode(self):
+        config = mock.MagicMock()
+        config.api_rate_limit = 0
+        config.api_client_max_connections = 0
+        config.api_max_queue = 0
+        self.assertFalse(manila.computed_haproxy_http_mode(config))
+        config.api_max_queue = 10
+        self.assertTrue(manila.computed_haproxy_http_mode(config))
+
+    def test_computed_haproxy_client_key(self):
+        config = mock.MagicMock()
+        config.charm_instance.get_state.return_value = None
+        self.assertEqual(manila.computed_haproxy_client_key(config), 'src')
+        config.charm_instance.get_state.return_value = True
+        self.assertEqual(manila.computed_haproxy_client_key(config),
+                         'req.hdr_ip(X-Forwarded-For,-1)')
+        config.charm_instance.get_state.assert_called_with('ssl.enabled')
+
+    def test_computed_log_level_overrides(self):
+        config = mock.MagicMock()
+        config.log_level_overrides = "sqlalchemy=WARN"
+        self.assertEqual(manila.computed_log_level_overrides(config),
+                         [('sqlalchemy', 'WARN')])
+        config.log_level_overrides = "sqlalchemy"
+        self.assertEqual(manila.computed_log_level_overrides(config), [])
+
+    def test_computed_default_log_levels(self):
+        config = mock.MagicMock()
+        config.log_level_overrides = ""
+        self.assertIsNone(manila.computed_default_log_levels(config))
+        config.log_level_overrides = "sqlalchemy=ERROR manila.share=DEBUG"
+        levels = manila.computed_default_log_levels(config).split(',')
+        self.assertIn('sqlalchemy=ERROR', levels)
+        self.assertNotIn('sqlalchemy=WARN', levels)
+        self.assertIn('amqp=WARN', levels)
+        self.assertEqual(levels[-1], 'manila.share=DEBUG')
+
 
 class TestManilaCharm(Helper):
 
@@ -96,14 +287,36 @@ class TestManilaCharm(Helper):
 
     def test_install(self):
         self.patch("subprocess.check_call", name="check_call")
-        self.patch("charms_openstack.charm.OpenStackCharm.assess_status",
-                   name="assess_status")
+        self.patch_object(manila.ManilaCharm, 'assess_status')
         self.patch('builtins.super', name='super')
         c = manila.ManilaCharm()
         c.install()
         self.check_call.assert_called_once_with(["mkdir", "-p", "/etc/nova"])
         self.assess_status.assert_called_once_with()
 
+    def test_assess_status_deferred_once_per_hook(self):
+        self.patch_object(manila.hookenv, 'atexit')
+        self.patch("charms_openstack.charm.OpenStackCharm.assess_status",
+                   name="assess_status")
+        self.patch_object(manila.ManilaCharm, '_assess_status_deferred',
+                          new=False)
+        c = manila.ManilaCharm()
+        c.assess_status()
+        c.assess_status()
+        c.assess_status()
+        self.atexit.assert_called_once_with(c._run_deferred_assess_status)
+        self.assess_status.assert_not_called()
+        calls = mock.Mock()
+        self.patch_object(manila.ManilaCharm, 'run_pending_restarts',
+                          new=calls.run_pending_restarts)
+        self.assess_status.side_effect = calls.assess_status
+        c._run_deferred_assess_status()
+        self.assess_status.assert_called_once_with()
+        self.assertFalse(manila.ManilaCharm._assess_status_deferred)
+        # the queued restarts run first, so the status reflects them.
+        self.assertEqual(calls.mock_calls, [mock.call.run_pending_restarts(),
+                                            mock.call.assess_status()])
+
     def _patch_get_adapter(self, c, adapters=None):
         self.patch_object(c, 'get_adapter')
         if adapters is None:
@@ -138,6 +351,15 @@ class TestManilaCharm(Helper):
     def test_custom_assess_status_check2(self):
         config = {
             'default-share-backend': 'name2',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'profiler': False,
+            'service-resource-controls': '',
+            'purge-deleted-rows-schedule': '',
+            'share-service-per-backend': False,
+            'data-mount-tmp-location': '',
+            'log-rate-limit-interval': 0,
+            'log-rate-limit-burst': 100,
         }
         c = self._patch_config_and_charm(config)
         self._patch_get_adapter(c)
@@ -148,6 +370,172 @@ class TestManilaCharm(Helper):
             ('blocked',
              "'default-share-backend:name2' is not a configured backend"))
         self.out.relation.names = ['name1', 'name2']
+        self.out.relation.get_configuration_data.return_value = {}
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_custom_assess_status_check_log_level_overrides(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': 'sqlalchemy',
+            'haproxy-balance': 'leastconn',
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'log-level-overrides': Invalid log level override: "
+                        "'sqlalchemy'"))
+
+    def test_custom_assess_status_check_haproxy_balance(self):
+        config = {
+            'default-share-backend': 'name1',
+            'haproxy-balance': 'fastest',
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'haproxy-balance:fastest' is not one of leastconn, "
+                        "roundrobin, static-rr, source, first"))
+
+    def test_custom_assess_status_check_resource_controls(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'service-resource-controls': 'manila-data:Nice=5',
+            'share-service-per-backend': False,
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'service-resource-controls': Invalid resource "
+                        "control: 'manila-data:Nice=5'"))
+
+    def test_custom_assess_status_check_purge_schedule(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'service-resource-controls': '',
+            'purge-deleted-rows-schedule': '0 3 * *',
+            'share-service-per-backend': False,
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'purge-deleted-rows-schedule': Invalid cron "
+                        "schedule: '0 3 * *'"))
+
+    def test_custom_assess_status_check_profiler(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'service-resource-controls': '',
+            'purge-deleted-rows-schedule': '',
+            'share-service-per-backend': False,
+            'data-mount-tmp-location': '',
+            'log-rate-limit-interval': 0,
+            'log-rate-limit-burst': 100,
+            'profiler': True,
+            'profiler-hmac-key': '',
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'profiler' is set but 'profiler-hmac-key' is not"))
+        config['profiler-hmac-key'] = 'SECRET'
+        self.out.relation.get_configuration_data.return_value = {}
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_custom_assess_status_check_conflicts(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'service-resource-controls': '',
+            'purge-deleted-rows-schedule': '',
+            'share-service-per-backend': False,
+            'data-mount-tmp-location': '',
+            'log-rate-limit-interval': 0,
+            'log-rate-limit-burst': 100,
+            'profiler': False,
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c, adapters=[manila.LOCAL_PLUGIN_RELATION,
+                                             manila.REMOTE_PLUGIN_RELATION])
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.out.relation.get_configuration_data.side_effect = [
+            {'name1': {'conf': 'local'}},
+            {'name1': {'conf': 'remote'}},
+        ]
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "Conflicting config from backend charms for: name1"))
+
+    def test_custom_assess_status_check_data_mount_tmp_location(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'service-resource-controls': '',
+            'purge-deleted-rows-schedule': '',
+            'share-service-per-backend': False,
+            'profiler': False,
+            'data-mount-tmp-location': 'srv/manila-data',
+            'log-rate-limit-interval': 0,
+            'log-rate-limit-burst': 100,
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'data-mount-tmp-location:srv/manila-data' is not an "
+                        "absolute path"))
+        config['data-mount-tmp-location'] = '/srv/manila-data'
+        self.out.relation.get_configuration_data.return_value = {}
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_custom_assess_status_check_log_rate_limit(self):
+        config = {
+            'default-share-backend': 'name1',
+            'log-level-overrides': '',
+            'haproxy-balance': 'leastconn',
+            'service-resource-controls': '',
+            'purge-deleted-rows-schedule': '',
+            'share-service-per-backend': False,
+            'profiler': False,
+            'data-mount-tmp-location': '',
+            'log-rate-limit-interval': 30,
+            'log-rate-limit-burst': 0,
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['name1']
+        self.assertEqual(
+            c.custom_assess_status_check(),
+            ('blocked', "'log-rate-limit-interval' is set but "
+                        "'log-rate-limit-burst' is not"))
+        config['log-rate-limit-burst'] = 100
+        self.out.relation.get_configuration_data.return_value = {}
         self.assertEqual(c.custom_assess_status_check(), (None, None))
 
     def test_get_amqp_credentials(self):
@@ -168,6 +556,600 @@ class TestManilaCharm(Helper):
             c.get_database_setup(),
             [dict(database='db1', username='user1')])
 
+    def test_alembic_head(self):
+        files = {
+            'a.py': "revision = '111'\ndown_revision = None\n",
+            'b.py': "revision = \"222\"\ndown_revision = '111'\n",
+            'c.py': "revision: str = '333'\n"
+                    "down_revision: Union[str, None] = '111'\n",
+            # a merge migration.
+            'd.py': "revision = '444'\n"
+                    "down_revision = (\n    '222',\n    '333',\n)\n",
+        }
+        self.patch_object(manila.glob, 'glob', return_value=sorted(files))
+        with mock.patch('builtins.open',
+                        side_effect=lambda f: mock.mock_open(
+                            read_data=files[f])()):
+            c = manila.ManilaCharm()
+            self.assertEqual(c.alembic_head, '444')
+            self.glob.return_value = ['a.py', 'b.py', 'c.py']
+            self.assertEqual(c.alembic_head, '222,333')
+
+    def test_migration_revisions(self):
+        self.assertEqual(
+            manila.migration_revisions(
+                '"""Merge heads."""\n'
+                'from alembic import op\n'
+                "revision = '444'\n"
+                "down_revision = ('222', '333')\n"
+                'def upgrade():\n'
+                "    revision = 'local'\n"),
+            {'revision': '444', 'down_revision': ('222', '333')})
+        self.assertEqual(manila.migration_revisions('revision ='), {})
+
+    def _patch_db_sync(self, marker, leader_marker, is_leader=True):
+        self.patch_object(manila.hookenv, 'is_leader', return_value=is_leader)
+        self.patch_object(manila.hookenv, 'leader_get',
+                          return_value=leader_marker)
+        self.patch_object(manila.hookenv, 'leader_set')
+        self.patch_object(manila.subprocess, 'check_call')
+        self.patch_object(manila.ManilaCharm, 'db_sync_marker',
+                          return_value=marker)
+        self.patch_object(manila.ManilaCharm, 'restart_all')
+        return manila.ManilaCharm()
+
+    def test_db_sync_marker(self):
+        self.patch_object(manila.fetch, 'get_installed_version')
+        self.get_installed_version.return_value.ver_str = '1:18.0.0-0ubuntu1'
+        self.patch_object(manila.ManilaCharm, 'alembic_head',
+                          new_callable=mock.PropertyMock, return_value='abc')
+        c = manila.ManilaCharm()
+        self.assertEqual(c.db_sync_marker(), '1:18.0.0-0ubuntu1:abc')
+        self.get_installed_version.assert_called_once_with('manila-common')
+
+    def test_db_sync(self):
+        c = self._patch_db_sync('1:abc', None)
+        self.assertTrue(c.db_sync())
+        self.check_call.assert_called_once_with(c.sync_cmd)
+        self.leader_set.assert_called_once_with(
+            {'db-sync-done': True, manila.DB_SYNC_MARKER_KEY: '1:abc'})
+        self.restart_all.assert_called_once_with()
+
+    def test_db_sync_unchanged(self):
+        c = self._patch_db_sync('1:abc', '1:abc')
+        self.assertFalse(c.db_sync())
+        self.check_call.assert_not_called()
+        self.assertTrue(c.db_sync(force=True))
+        self.check_call.assert_called_once_with(c.sync_cmd)
+
+    def test_db_sync_not_leader(self):
+        c = self._patch_db_sync('1:abc', None, is_leader=False)
+        self.assertFalse(c.db_sync())
+        self.check_call.assert_not_called()
+
+    def test_db_sync_no_restart(self):
+        c = self._patch_db_sync('1:abc', None)
+        self.assertTrue(c.db_sync(restart=False))
+        self.check_call.assert_called_once_with(c.sync_cmd)
+        self.restart_all.assert_not_called()
+
+    def test_fetch_upgrade_packages(self):
+        self.patch_object(manila.os_utils, 'configure_installation_source')
+        self.patch_object(manila.fetch, 'apt_update')
+        self.patch_object(manila.fetch, 'apt_upgrade')
+        self.patch_object(manila.fetch, 'apt_install')
+        c = manila.ManilaCharm()
+        c.config = {'openstack-origin': 'cloud:jammy-caracal'}
+        c.fetch_upgrade_packages()
+        self.configure_installation_source.assert_called_once_with(
+            'cloud:jammy-caracal')
+        self.apt_update.assert_called_once_with(fatal=True)
+        self.apt_upgrade.assert_called_once_with(
+            options=['--download-only'], fatal=True, dist=True)
+        self.apt_install.assert_called_once_with(
+            c.all_packages, options=['--download-only'], fatal=True)
+
+    def test_run_upgrade(self):
+        calls = mock.MagicMock()
+        self.patch_object(manila.ManilaCharm, 'services',
+                          new_callable=mock.PropertyMock,
+                          return_value=['apache2', 'haproxy',
+                                        'manila-scheduler', 'manila-data'])
+        self.patch_object(manila.ManilaCharm, 'fetch_upgrade_packages',
+                          new=calls.fetch_upgrade_packages)
+        self.patch_object(manila.host, 'service_stop',
+                          new=calls.service_stop)
+        self.patch_object(manila.ManilaCharm, 'do_openstack_pkg_upgrade',
+                          new=calls.do_openstack_pkg_upgrade)
+        self.patch_object(manila.ManilaCharm,
+                          'do_openstack_upgrade_config_render',
+                          new=calls.do_openstack_upgrade_config_render)
+        self.patch_object(manila.ManilaCharm, 'db_sync', new=calls.db_sync)
+        self.patch_object(manila.ManilaCharm, 'queue_service_action',
+                          new=calls.queue_service_action)
+        self.patch_object(manila.ManilaCharm, 'run_pending_restarts',
+                          new=calls.run_pending_restarts)
+        self.patch_object(manila.hookenv, 'log')
+        self.patch_object(manila.ManilaCharm, 'upgrades', new=0)
+        c = manila.ManilaCharm()
+        timings = c.run_upgrade(interfaces_list=['iface'])
+        self.assertEqual(manila.ManilaCharm.upgrades, 1)
+        self.assertEqual(list(timings),
+                         ['fetch', 'stop', 'install', 'render', 'db-sync',
+                          'restart'])
+        # everything is downloaded before anything is stopped, and the API
+        # services are only restarted, at the end.
+        self.assertEqual(calls.mock_calls, [
+            mock.call.fetch_upgrade_packages(),
+            mock.call.service_stop('manila-scheduler'),
+            mock.call.service_stop('manila-data'),
+            mock.call.do_openstack_pkg_upgrade(),
+            mock.call.do_openstack_upgrade_config_render(['iface']),
+            mock.call.db_sync(restart=False),
+            mock.call.queue_service_action('apache2', 'restart'),
+            mock.call.queue_service_action('haproxy', 'restart'),
+            mock.call.queue_service_action('manila-scheduler', 'restart'),
+            mock.call.queue_service_action('manila-data', 'restart'),
+            mock.call.run_pending_restarts(),
+        ])
+
+    def test_purge_deleted_rows(self):
+        self.patch_object(manila.subprocess, 'check_output')
+        self.check_output.return_value = (
+            "Deleted 3 rows in table shares.\n"
+            "Deleted 4 rows in table messages.\n")
+        self.patch_object(manila.time, 'time', new=mock.Mock(
+            side_effect=[10.0, 12.5]))
+        c = manila.ManilaCharm()
+        self.assertEqual(c.purge_deleted_rows(7), (7, 2.5))
+        self.check_output.assert_called_once_with(
+            ['sudo', 'manila-manage', 'db', 'purge', '7'],
+            stderr=manila.subprocess.STDOUT,
+            universal_newlines=True)
+        # the count is unknown if manila-manage doesn't log it.
+        self.check_output.return_value = ''
+        self.time.side_effect = [20.0, 21.0]
+        self.assertEqual(c.purge_deleted_rows(7), (None, 1.0))
+
+    def test_configure_purge_cron(self):
+        c = self._patch_config_and_charm({
+            'purge-deleted-rows-schedule': '0 3 * * 0',
+            'purge-deleted-rows-age': 30,
+        })
+        self.patch_object(manila.hookenv, 'is_leader', return_value=True)
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.os.path, 'exists', return_value=True)
+        self.patch_object(manila.os, 'remove')
+        c.configure_purge_cron()
+        self.write_file.assert_called_once_with(
+            manila.MANILA_PURGE_CRON,
+            ('# Managed by juju\n'
+             '0 3 * * 0 manila /usr/bin/manila-manage db purge 30 >> '
+             '/var/log/manila/manila-purge-deleted-rows.log 2>&1\n'
+             ).encode('utf-8'),
+            perms=0o644)
+        self.remove.assert_not_called()
+        self.is_leader.return_value = False
+        c.configure_purge_cron()
+        self.remove.assert_called_once_with(manila.MANILA_PURGE_CRON)
+
+    def test_configure_purge_cron_invalid(self):
+        c = self._patch_config_and_charm({
+            'purge-deleted-rows-schedule': '0 3 * * 0\n* * * * * root sh',
+            'purge-deleted-rows-age': 30,
+        })
+        self.patch_object(manila.hookenv, 'is_leader', return_value=True)
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.os.path, 'exists', return_value=True)
+        self.patch_object(manila.os, 'remove')
+        c.configure_purge_cron()
+        self.write_file.assert_not_called()
+        self.remove.assert_called_once_with(manila.MANILA_PURGE_CRON)
+
+    def test_computed_profiler_connection_string(self):
+        config = mock.MagicMock()
+        config.profiler_connection_string = ''
+        self.assertEqual(
+            manila.computed_profiler_connection_string(config),
+            'messaging://')
+        config.profiler_connection_string = 'redis://127.0.0.1:6379'
+        self.assertEqual(
+            manila.computed_profiler_connection_string(config),
+            'redis://127.0.0.1:6379')
+
+    def test_configure_profiler(self):
+        config = {
+            'profiler': True,
+            'profiler-connection-string': 'redis://127.0.0.1:6379',
+        }
+        c = self._patch_config_and_charm(config)
+        self.patch_object(manila.fetch, 'apt_install')
+        self.patch_object(manila.fetch, 'filter_installed_packages',
+                          side_effect=lambda pkgs: pkgs)
+        c.configure_profiler()
+        self.apt_install.assert_called_once_with(['python3-redis'],
+                                                 fatal=True)
+        self.apt_install.reset_mock()
+        config['profiler-connection-string'] = ''
+        c.configure_profiler()
+        self.apt_install.assert_not_called()
+
+    def test_configure_data_mount_location(self):
+        config = {'data-mount-tmp-location': '/srv/manila-data'}
+        c = self._patch_config_and_charm(config)
+        self.patch_object(manila.host, 'mkdir')
+        c.configure_data_mount_location()
+        self.mkdir.assert_called_once_with('/srv/manila-data', owner='manila',
+                                           group='manila', perms=0o750)
+        self.mkdir.reset_mock()
+        for path in ('', 'srv/manila-data'):
+            config['data-mount-tmp-location'] = path
+            c.configure_data_mount_location()
+        self.mkdir.assert_not_called()
+
+    def test_configure_resource_controls(self):
+        c = self._patch_config_and_charm({
+            'service-resource-controls':
+                'manila-data:CPUWeight=20 manila-data:IOWeight=20',
+        })
+        self.patch_object(manila.ManilaCharm, 'services',
+                          new_callable=mock.PropertyMock,
+                          return_value=['apache2', 'manila-data'])
+        self.patch_object(c, 'restart_on_change')
+        self.patch_object(manila.os.path, 'exists', return_value=True)
+        self.patch_object(manila.os, 'remove')
+        self.patch_object(manila.host, 'file_hash', return_value='old')
+        self.patch_object(manila.host, 'mkdir')
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.subprocess, 'check_call')
+        c.configure_resource_controls()
+        apache2_conf = manila.SYSTEMD_RESOURCE_CONTROLS_CONF.format('apache2')
+        data_conf = manila.SYSTEMD_RESOURCE_CONTROLS_CONF.format(
+            'manila-data')
+        self.restart_on_change.assert_called_once_with(
+            {apache2_conf: ['apache2'], data_conf: ['manila-data']})
+        self.remove.assert_called_once_with(apache2_conf)
+        self.write_file.assert_called_once_with(
+            data_conf,
+            b'# Managed by juju\n[Service]\nCPUWeight=20\nIOWeight=20\n',
+            perms=0o644)
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'daemon-reload'])
+        # nothing to do if the drop-ins are up to date.
+        self.exists.side_effect = lambda p: p == data_conf
+        self.file_hash.return_value = manila.hashlib.md5(
+            self.write_file.call_args[0][1]).hexdigest()
+        self.write_file.reset_mock()
+        self.check_call.reset_mock()
+        c.configure_resource_controls()
+        self.write_file.assert_not_called()
+        self.check_call.assert_not_called()
+
+    def test_share_services(self):
+        config = {'share-service-per-backend': False}
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['b', 'a']
+        self.assertEqual(c.share_services, ['manila-share'])
+        self.assertEqual(c.services[-1], 'manila-share')
+        config['share-service-per-backend'] = True
+        self.assertEqual(c.share_services,
+                         ['manila-share@a', 'manila-share@b'])
+        self.assertEqual(c.services,
+                         ['apache2', 'haproxy', 'manila-scheduler',
+                          'manila-data', 'manila-share@a', 'manila-share@b'])
+
+    def _patch_share_instances(self, existing, backends, per_backend=True):
+        c = self._patch_config_and_charm(
+            {'share-service-per-backend': per_backend})
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = backends
+        self.patch_object(manila.glob, 'glob', return_value=[
+            manila.MANILA_SHARE_BACKEND_CONF.format(b) for b in existing])
+        self.patch_object(manila.os.path, 'exists', return_value=True)
+        self.patch_object(manila.os, 'remove')
+        self.patch_object(manila.host, 'file_hash', return_value='old')
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.host, 'mkdir')
+        self.patch_object(manila.host, 'service')
+        self.patch_object(manila.host, 'service_stop')
+        self.patch_object(manila.subprocess, 'check_call')
+        self.patch_object(c, 'queue_service_action')
+        return c
+
+    def test_configure_share_instances(self):
+        c = self._patch_share_instances([], ['generic'])
+        self.assertTrue(c.configure_share_instances())
+        unit = self.write_file.call_args_list[0][0][1].decode('utf-8')
+        self.assertIn('ExecStart=/usr/bin/manila-share '
+                      '--config-file=/etc/manila/manila.conf '
+                      '--config-file=/etc/manila/manila-share.d/%i.conf ',
+                      unit)
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'daemon-reload'])
+        self.service_stop.assert_called_once_with('manila-share')
+        self.write_file.assert_called_with(
+            '/etc/manila/manila-share.d/generic.conf',
+            b'# Managed by juju\n[DEFAULT]\n'
+            b'enabled_share_backends = generic\n',
+            owner='root', group='manila', perms=0o640)
+        self.service.assert_has_calls([
+            mock.call('disable', 'manila-share'),
+            mock.call('enable', 'manila-share@generic')])
+        self.queue_service_action.assert_called_once_with(
+            'manila-share@generic', 'restart')
+
+    def test_configure_share_instances_backend_removed(self):
+        c = self._patch_share_instances(['generic', 'old'], ['generic'])
+        self.file_hash.side_effect = lambda p: (
+            manila.hashlib.md5(b'# Managed by juju\n[DEFAULT]\n'
+                               b'enabled_share_backends = generic\n')
+            .hexdigest() if p.endswith('generic.conf') else 'same')
+        self.assertTrue(c.configure_share_instances())
+        self.service_stop.assert_called_once_with('manila-share@old')
+        self.service.assert_called_once_with('disable', 'manila-share@old')
+        self.remove.assert_called_once_with(
+            '/etc/manila/manila-share.d/old.conf')
+        self.queue_service_action.assert_not_called()
+
+    def test_configure_share_instances_disabled(self):
+        c = self._patch_share_instances(['generic'], ['generic'],
+                                        per_backend=False)
+        self.assertTrue(c.configure_share_instances())
+        self.service_stop.assert_called_once_with('manila-share@generic')
+        self.service.assert_has_calls([
+            mock.call('disable', 'manila-share@generic'),
+            mock.call('enable', 'manila-share')])
+        self.queue_service_action.assert_called_once_with(
+            'manila-share', 'restart')
+        self.write_file.assert_not_called()
+        # nothing to do once the instances are gone.
+        self.glob.return_value = []
+        self.queue_service_action.reset_mock()
+        self.assertFalse(c.configure_share_instances())
+        self.queue_service_action.assert_not_called()
+
+    def test_configure_share_instances_enable_share(self):
+        # the instances went with the local backend before the mode was
+        # turned off, leaving manila-share disabled.
+        c = self._patch_share_instances([], ['generic'], per_backend=False)
+        self.service.side_effect = lambda action, name: action != 'is-enabled'
+        self.assertFalse(c.configure_share_instances())
+        self.service.assert_has_calls([
+            mock.call('is-enabled', 'manila-share'),
+            mock.call('enable', 'manila-share')])
+        self.queue_service_action.assert_called_once_with(
+            'manila-share', 'restart')
+        self.service.side_effect = None
+        self.service.reset_mock()
+        self.queue_service_action.reset_mock()
+        c.configure_share_instances()
+        self.service.assert_called_once_with('is-enabled', 'manila-share')
+        self.queue_service_action.assert_not_called()
+
+    def test_resource_controls(self):
+        config = {
+            'share-service-per-backend': True,
+            'service-resource-controls':
+                'manila-share:CPUWeight=20 manila-share:MemoryHigh=4G '
+                'manila-share@b:CPUWeight=50 manila-data:IOWeight=20',
+        }
+        c = self._patch_config_and_charm(config)
+        self._patch_get_adapter(c)
+        self.out = mock.Mock()
+        self.out.relation.names = ['a', 'b']
+        controls = c.resource_controls
+        self.assertNotIn('manila-share', controls)
+        self.assertEqual(controls['manila-share@a'],
+                         {'CPUWeight': '20', 'MemoryHigh': '4G'})
+        self.assertEqual(controls['manila-share@b'],
+                         {'CPUWeight': '50', 'MemoryHigh': '4G'})
+        self.assertEqual(controls['manila-data'], {'IOWeight': '20'})
+        config['share-service-per-backend'] = False
+        with self.assertRaises(ValueError):
+            c.resource_controls
+        config['service-resource-controls'] = 'manila-share:CPUWeight=20'
+        self.assertEqual(c.resource_controls,
+                         {'manila-share': {'CPUWeight': '20'}})
+
+    def test_configure_version_cache(self):
+        config = {'api-version-cache-ttl': 0}
+        c = self._patch_config_and_charm(config)
+        store = {}
+        db = mock.MagicMock()
+        db.get.side_effect = lambda k, d=None: store.get(k, d)
+        db.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        self.patch_object(manila.unitdata, 'kv', return_value=db)
+        self.patch_object(manila.fetch, 'get_installed_version')
+        self.get_installed_version.return_value.ver_str = '1:18.0.0'
+        self.patch_object(c, 'enable_apache_modules')
+        self.patch_object(c, 'queue_service_action')
+        c.configure_version_cache()
+        self.enable_apache_modules.assert_not_called()
+        config['api-version-cache-ttl'] = 30
+        c.configure_version_cache()
+        self.enable_apache_modules.assert_called_once_with(
+            ['cache', 'cache_socache', 'socache_shmcb', 'headers'])
+        self.queue_service_action.assert_not_called()
+        # a new package version empties the cache.
+        self.get_installed_version.return_value.ver_str = '1:18.1.0'
+        c.configure_version_cache()
+        self.queue_service_action.assert_called_once_with(
+            'apache2', 'restart')
+
+    def test_configure_http2(self):
+        c = self._patch_config_and_charm({'api-http2': True})
+        self.patch_object(c, 'get_state', return_value=True)
+        self.patch_object(c, 'queue_service_action')
+        self.patch_object(manila.subprocess, 'call', return_value=1)
+        self.patch_object(manila.subprocess, 'check_call')
+        c.configure_http2()
+        self.call.assert_called_once_with(['a2query', '-m', 'http2'])
+        self.check_call.assert_called_once_with(['a2enmod', 'http2'])
+        self.queue_service_action.assert_called_once_with(
+            'apache2', 'restart')
+        # already enabled
+        self.call.return_value = 0
+        self.check_call.reset_mock()
+        c.configure_http2()
+        self.check_call.assert_not_called()
+        # no TLS
+        self.get_state.return_value = False
+        self.call.reset_mock()
+        c.configure_http2()
+        self.call.assert_not_called()
+
+    def test_configure_compression(self):
+        config = {'api-compression': False}
+        c = self._patch_config_and_charm(config)
+        self.patch_object(c, 'enable_apache_modules')
+        c.configure_compression()
+        self.enable_apache_modules.assert_not_called()
+        config['api-compression'] = True
+        c.configure_compression()
+        self.enable_apache_modules.assert_called_once_with(
+            ['deflate', 'filter'])
+
+    def _patch_restart_queue(self, paused=False):
+        self.store = {}
+        db = mock.MagicMock()
+        db.get.side_effect = lambda k, d=None: self.store.get(k, d)
+        db.set.side_effect = lambda k, v: self.store.__setitem__(k, v)
+        db.unset.side_effect = lambda k: self.store.pop(k, None)
+        self.patch_object(manila.unitdata, 'kv', return_value=db)
+        self.patch_object(manila.hookenv, 'atexit')
+        self.patch_object(manila.os_utils, 'is_unit_paused_set',
+                          return_value=paused)
+        self.patch_object(manila.host, 'service_restart')
+        self.patch_object(manila.host, 'service_reload')
+        self.patch_object(manila.host, 'service_running', return_value=True)
+        self.patch_object(manila.ManilaCharm, '_restarts_deferred',
+                          new=False)
+        return manila.ManilaCharm()
+
+    def test_queue_service_action(self):
+        c = self._patch_restart_queue()
+        c.queue_service_action('apache2', 'reload')
+        c.queue_service_action('haproxy', 'restart')
+        c.queue_service_action('manila-scheduler', 'restart')
+        c.queue_service_action('apache2', 'restart')
+        c.queue_service_action('apache2', 'reload')
+        self.atexit.assert_called_once_with(c.run_pending_restarts)
+        self.assertEqual(c.pending_restarts,
+                         [('manila-scheduler', 'restart'),
+                          ('apache2', 'restart'),
+                          ('haproxy', 'restart')])
+        c.run_pending_restarts()
+        self.service_restart.assert_has_calls([
+            mock.call('manila-scheduler'),
+            mock.call('apache2'),
+            mock.call('haproxy')])
+        self.service_reload.assert_not_called()
+        self.assertEqual(c.pending_restarts, [])
+
+    def test_run_pending_restarts_reload(self):
+        c = self._patch_restart_queue()
+        c.queue_service_action('apache2', 'reload')
+        self.assertEqual(c.run_pending_restarts(), [('apache2', 'reload')])
+        self.service_reload.assert_called_once_with(
+            'apache2', restart_on_failure=True)
+
+    def test_run_pending_restarts_paused(self):
+        c = self._patch_restart_queue(paused=True)
+        c.queue_service_action('apache2', 'restart')
+        self.assertEqual(c.run_pending_restarts(), [])
+        self.service_restart.assert_not_called()
+        self.assertEqual(c.pending_restarts, [('apache2', 'restart')])
+
+    def test_restart_on_change(self):
+        c = self._patch_restart_queue()
+        self.patch_object(manila.ManilaCharm, 'full_restart_map',
+                          new_callable=mock.PropertyMock,
+                          return_value={'a.conf': ['apache2'],
+                                        'b.conf': ['manila-data']})
+        hashes = {'a.conf': ['1', '2'], 'b.conf': ['1', '1']}
+        self.patch_object(manila.host, 'path_hash',
+                          side_effect=lambda p: hashes[p].pop(0))
+        with c.restart_on_change():
+            pass
+        self.assertEqual(c.pending_restarts, [('apache2', 'restart')])
+        self.service_restart.assert_not_called()
+
+    def test_restart_on_change_mutable_only(self):
+        c = self._patch_restart_queue()
+        self.patch_object(manila.ManilaCharm, 'full_restart_map',
+                          new_callable=mock.PropertyMock,
+                          return_value={manila.MANILA_CONF: [
+                              'apache2', 'manila-scheduler']})
+        self.patch_object(manila.host, 'path_hash',
+                          side_effect=['1', '2'])
+        self.patch_object(manila, 'immutable_config_hash',
+                          side_effect=['x', 'x'])
+        with c.restart_on_change():
+            pass
+        self.assertEqual(c.pending_restarts,
+                         [('manila-scheduler', 'hup'),
+                          ('apache2', 'reload')])
+
+    def test_queue_service_action_priority(self):
+        c = self._patch_restart_queue()
+        c.queue_service_action('manila-data', 'hup')
+        self.assertEqual(c.pending_restarts, [('manila-data', 'hup')])
+        c.queue_service_action('manila-data', 'restart')
+        c.queue_service_action('manila-data', 'hup')
+        self.assertEqual(c.pending_restarts, [('manila-data', 'restart')])
+
+    def test_run_pending_restarts_hup(self):
+        c = self._patch_restart_queue()
+        self.patch_object(manila.subprocess, 'check_call')
+        c.queue_service_action('manila-share', 'hup')
+        c.run_pending_restarts()
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'kill', '--kill-who=main', '--signal=HUP',
+             'manila-share'])
+        self.service_restart.assert_not_called()
+
+    def test_run_pending_restarts_hup_stopped(self):
+        c = self._patch_restart_queue()
+        self.patch_object(manila.subprocess, 'check_call')
+        self.service_running.return_value = False
+        c.queue_service_action('manila-share', 'hup')
+        self.assertEqual(c.run_pending_restarts(),
+                         [('manila-share', 'restart')])
+        self.service_restart.assert_called_once_with('manila-share')
+        self.check_call.assert_not_called()
+
+    def test_run_pending_restarts_failed(self):
+        c = self._patch_restart_queue()
+        self.patch_object(manila.hookenv, 'log')
+        self.patch_object(
+            manila.subprocess, 'check_call',
+            side_effect=manila.subprocess.CalledProcessError(1, 'systemctl'))
+        c.queue_service_action('manila-scheduler', 'hup')
+        c.queue_service_action('apache2', 'reload')
+        self.assertEqual(c.run_pending_restarts(), [('apache2', 'reload')])
+        self.service_reload.assert_called_once_with(
+            'apache2', restart_on_failure=True)
+        # the failed action is left for the next hook.
+        self.assertEqual(c.pending_restarts, [('manila-scheduler', 'hup')])
+
+    def test_publish_api_capacity(self):
+        c = self._patch_config_and_charm({})
+        self.patch_object(manila, 'local_api_capacity', return_value=4)
+        self.patch_object(manila, 'computed_wsgi_capacity', return_value=8)
+        self.patch_object(manila.os, 'sched_getaffinity',
+                          return_value=set(range(4)))
+        self.patch_object(manila.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(manila.hookenv, 'relation_set')
+        c.publish_api_capacity()
+        self.relation_set.assert_called_once_with(
+            relation_id='cluster:1',
+            relation_settings={'api-capacity': 4, 'wsgi-capacity': 8,
+                               'cpu-cores': 4})
+
     def test_register_endpoints(self):
         # note that this also tests _custom_register_endpoints() indirectly,
         # which means it doesn't require a separate test.
@@ -210,6 +1192,25 @@ class TestManilaCharm(Helper):
         calls = [v1, v2]
         relation.to_publish_raw.update.assert_has_calls(calls)
 
+    def test_custom_register_endpoints_unchanged(self):
+        relation = mock.MagicMock()
+        relation.to_publish_raw = mock.MagicMock(wraps={
+            'v1_service': 'manila',
+            'v1_public_url': 'p1',
+            'v1_internal_url': 'i1',
+            'v1_admin_url': 'a1',
+            'v1_region': 'the_region',
+        })
+        keystone = mock.MagicMock()
+        keystone.relations = [relation]
+        manila.ManilaCharm._custom_register_endpoints(
+            keystone, 'v1', 'manila', 'the_region', 'p1', 'i1', 'a1')
+        relation.to_publish_raw.update.assert_not_called()
+        manila.ManilaCharm._custom_register_endpoints(
+            keystone, 'v1', 'manila', 'the_region', 'p1', 'i1', 'a2')
+        relation.to_publish_raw.update.assert_called_once_with(
+            {'v1_admin_url': 'a2'})
+
     def test_url_endpoints_creation(self):
         # Tests that the endpoint functions call through to the baseclass
         self.patch_object(manila.charms_openstack.charm.OpenStackCharm,
@@ -282,13 +1283,41 @@ class TestManilaCharm(Helper):
         self.assertEqual(c.config_lines_for('conf2'), ["conf2-string", ''])
         self.assertEqual(c.config_lines_for('conf3'), ["conf3-string", ''])
 
+    def test_config_lines_for_duplicates(self):
+        c = self._patch_config_and_charm({})
+        local = mock.Mock()
+        local.relation.get_configuration_data.return_value = {
+            'b': {'conf': 'b-string'},
+            'a': {'conf': 'a-string', 'conf2': 'shared-string'},
+        }
+        remote = mock.Mock()
+        remote.relation.get_configuration_data.return_value = {
+            # same backend over both relations; written once.
+            'a': {'conf': 'a-string'},
+            # same name, different content; the local one wins.
+            'b': {'conf': 'b-remote-string'},
+            # an identical chunk under another name is dropped.
+            'c': {'conf2': 'shared-string'},
+            'd': {'conf': 'd-string'},
+        }
+        self.patch_object(manila.ManilaCharm, 'manila_plugin_adapters',
+                          new_callable=mock.PropertyMock,
+                          return_value=[local, remote])
+        self.assertEqual(c.config_lines_for('conf'),
+                         ['a-string', '', 'b-string', '', 'd-string', ''])
+        self.assertEqual(c.config_lines_for('conf2'), ['shared-string', ''])
+        self.assertEqual(c.plugin_config_index[1], [('conf', 'b')])
+        self.assertEqual(sorted(c.config_files()), ['conf', 'conf2'])
+
     def test_render_nrpe_checks(self):
         """Test NRPE renders correctly"""
         self.patch_object(manila.nrpe, 'NRPE')
         self.patch_object(manila.nrpe, 'add_init_service_checks')
+        self.patch_object(manila.ManilaCharm, 'add_api_checks')
 
-        target = manila.ManilaCharm()
+        target = self._patch_config_and_charm({'metrics-exporter-port': 0})
         target.render_nrpe_checks()
+        self.add_api_checks.assert_called_once_with(self.NRPE.return_value)
 
         self.add_init_service_checks.assert_has_calls([
             mock.call().add_init_service_checks(
@@ -301,6 +1330,222 @@ class TestManilaCharm(Helper):
             mock.call().write(),
         ])
 
+    def test_add_api_checks(self):
+        c = self._patch_config_and_charm({
+            'api-check-latency-warn': 1000,
+            'api-check-latency-crit': 5000,
+            'api-check-window': 300,
+            'api-check-p95-warn': 2000,
+            'api-check-p95-crit': 10000,
+            'api-check-error-rate-warn': 5,
+            'api-check-error-rate-crit': 20,
+        })
+        self.patch_object(manila.nrpe, 'copy_nrpe_checks')
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.hookenv, 'charm_dir', return_value='/charm')
+        self.patch_object(c, 'get_state', return_value=False)
+        charm_nrpe = mock.MagicMock()
+        c.add_api_checks(charm_nrpe)
+        self.copy_nrpe_checks.assert_called_once_with(
+            nrpe_files_dir='/charm/files/nagios')
+        self.write_file.assert_called_once_with(
+            '/etc/sudoers.d/manila-nagios',
+            b'# Managed by juju\n'
+            b'nagios ALL=(root) NOPASSWD: '
+            b'/usr/local/lib/nagios/plugins/check_manila_api.py access-log '
+            b'--log /var/log/apache2/manila_access.log --window 300 '
+            b'--warn-p95 2000 --crit-p95 10000 --warn-5xx 5 --crit-5xx 20\n',
+            perms=0o440)
+        charm_nrpe.add_check.assert_has_calls([
+            mock.call(
+                shortname='manila_api_versions_8786',
+                description='manila API versions latency on port 8786',
+                check_cmd=('check_manila_api.py versions '
+                           '--url http://localhost:8786/ '
+                           '--warn 1000 --crit 5000')),
+            mock.call(
+                shortname='manila_api_access_log',
+                description='manila API p95 latency and 5xx rate',
+                check_cmd=('check_manila_api_access_log '
+                           '--log /var/log/apache2/manila_access.log '
+                           '--window 300 --warn-p95 2000 --crit-p95 10000 '
+                           '--warn-5xx 5 --crit-5xx 20')),
+        ])
+        self.assertEqual(charm_nrpe.add_check.call_count, 2)
+
+    def test_add_api_checks_tls(self):
+        c = self._patch_config_and_charm({
+            'api-check-latency-warn': 1000,
+            'api-check-latency-crit': 5000,
+            'api-check-window': 300,
+            'api-check-p95-warn': 2000,
+            'api-check-p95-crit': 10000,
+            'api-check-error-rate-warn': 5,
+            'api-check-error-rate-crit': 20,
+        })
+        self.patch_object(manila.nrpe, 'copy_nrpe_checks')
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.hookenv, 'charm_dir', return_value='/charm')
+        self.patch_object(c, 'get_state', return_value=True)
+        self.patch_object(manila.ManilaCharm, 'api_check_host',
+                          new_callable=mock.PropertyMock,
+                          return_value='10.0.0.10')
+        charm_nrpe = mock.MagicMock()
+        c.add_api_checks(charm_nrpe)
+        charm_nrpe.add_check.assert_any_call(
+            shortname='manila_api_versions_8786',
+            description='manila API versions latency on port 8786',
+            check_cmd=('check_manila_api.py versions '
+                       '--url https://10.0.0.10:8786/ '
+                       '--warn 1000 --crit 5000'))
+
+    def test_remove_nagios_sudoers(self):
+        self.patch_object(manila.os.path, 'exists', return_value=False)
+        self.patch_object(manila.os, 'remove')
+        manila.remove_nagios_sudoers()
+        self.remove.assert_not_called()
+        self.exists.return_value = True
+        manila.remove_nagios_sudoers()
+        self.remove.assert_called_once_with('/etc/sudoers.d/manila-nagios')
+
+    def test_api_check_host(self):
+        c = manila.ManilaCharm()
+        self.patch_object(c, 'get_state', return_value=False)
+        options = mock.MagicMock()
+        options.endpoints = [('10.0.0.10', 'manila.example.com', 8776, 8766)]
+        self.patch_object(manila.ManilaCharm, 'options',
+                          new_callable=mock.PropertyMock,
+                          return_value=options)
+        self.assertEqual(c.api_check_host, 'localhost')
+        # the TLS virtual hosts are bound to the unit's addresses.
+        self.get_state.return_value = True
+        self.assertEqual(c.api_check_host, '10.0.0.10')
+        options.endpoints = [('fd00::10', 'fd00::10', 8776, 8766)]
+        self.assertEqual(c.api_check_host, '[fd00::10]')
+        options.endpoints = []
+        self.assertEqual(c.api_check_host, 'localhost')
+
+    def test_render_nrpe_checks_exporter(self):
+        self.patch_object(manila.nrpe, 'NRPE')
+        self.patch_object(manila.nrpe, 'add_init_service_checks')
+        self.patch_object(manila.ManilaCharm, 'add_api_checks')
+        target = self._patch_config_and_charm({'metrics-exporter-port': 9876})
+        target.render_nrpe_checks()
+        self.add_init_service_checks.assert_called_with(
+            mock.ANY, ['manila-exporter'], mock.ANY)
+
+    def _patch_exporter(self, port, compression=False, address=''):
+        c = self._patch_config_and_charm({'metrics-exporter-port': port,
+                                          'metrics-exporter-address': address,
+                                          'api-compression': compression})
+        self.patch_object(manila.fetch, 'apt_install')
+        self.patch_object(manila.fetch, 'filter_installed_packages',
+                          side_effect=lambda pkgs: pkgs)
+        self.patch_object(manila.host, 'adduser')
+        self.patch_object(manila.shutil, 'rmtree')
+        self.patch_object(manila.os.path, 'isdir', return_value=True)
+        self.patch_object(manila.subprocess, 'call')
+        self.patch_object(manila.hookenv, 'charm_dir', return_value='/charm')
+        self.patch_object(manila.hookenv, 'local_unit',
+                          return_value='manila/0')
+        self.patch_object(manila.hookenv, 'unit_private_ip',
+                          return_value='10.0.0.10')
+        self.patch_object(manila.host, 'file_hash')
+        self.patch_object(manila.host, 'write_file')
+        self.patch_object(manila.host, 'mkdir')
+        self.patch_object(manila.host, 'service')
+        self.patch_object(manila.host, 'service_stop')
+        self.patch_object(manila.shutil, 'copy2')
+        self.patch_object(manila.os, 'chmod')
+        self.patch_object(manila.os, 'remove')
+        self.patch_object(manila.os.path, 'exists', return_value=True)
+        self.patch_object(manila.subprocess, 'check_call')
+        self.patch_object(c, 'queue_service_action')
+        self.patch_object(manila.ManilaCharm, 'services',
+                          new_callable=mock.PropertyMock,
+                          return_value=['apache2', 'manila-data'])
+        return c
+
+    def test_configure_metrics_exporter(self):
+        c = self._patch_exporter(9876)
+        self.file_hash.side_effect = ['new', 'old', 'old']
+        c.configure_metrics_exporter()
+        self.copy2.assert_called_once_with('/charm/files/manila_exporter.py',
+                                           manila.MANILA_EXPORTER)
+        unit = self.write_file.call_args_list[0][0][1].decode('utf-8')
+        self.assertIn('ExecStart=/usr/bin/python3 /usr/local/bin/'
+                      'manila-exporter --address 10.0.0.10 --port 9876 ',
+                      unit)
+        self.assertIn('--service apache2 --service manila-data\n'
+                      'User=manila-exporter\n', unit)
+        self.assertNotIn('adm', unit)
+        self.apt_install.assert_called_once_with(['acl'], fatal=True)
+        self.adduser.assert_called_once_with(
+            'manila-exporter', shell='/usr/sbin/nologin', system_user=True)
+        self.write_file.assert_any_call(
+            manila.MANILA_EXPORTER_SCRAPE_CONF,
+            (b"- job_name: manila-0\n"
+             b"  static_configs:\n"
+             b"    - targets: ['10.0.0.10:9876']\n"
+             b"      labels:\n"
+             b"        juju_unit: manila/0\n"),
+            perms=0o644)
+        # read access to the manila access log, and no other.
+        self.assertEqual(self.check_call.call_args_list, [
+            mock.call(['setfacl', '-m', 'u:manila-exporter:x',
+                       '/var/log/apache2']),
+            mock.call(['setfacl', '-m', 'u:manila-exporter:r',
+                       '/var/log/apache2/manila_access.log']),
+            mock.call(['systemctl', 'daemon-reload'])])
+        self.service.assert_called_once_with('enable', 'manila-exporter')
+        self.queue_service_action.assert_called_once_with(
+            'manila-exporter', 'restart')
+
+    def test_configure_metrics_exporter_compression(self):
+        c = self._patch_exporter(9876, compression=True)
+        self.file_hash.side_effect = ['same', 'same', 'old']
+        c.configure_metrics_exporter()
+        unit = self.write_file.call_args_list[0][0][1].decode('utf-8')
+        self.assertIn('--compression-log /var/log/apache2/manila_deflate.log '
+                      '--service apache2', unit)
+        self.check_call.assert_any_call(
+            ['setfacl', '-m', 'u:manila-exporter:r',
+             '/var/log/apache2/manila_deflate.log'])
+
+    def test_configure_metrics_exporter_address(self):
+        c = self._patch_exporter(9876, address='fd00::10')
+        self.file_hash.side_effect = ['same', 'same', 'old']
+        c.configure_metrics_exporter()
+        unit = self.write_file.call_args_list[0][0][1].decode('utf-8')
+        self.assertIn('--address fd00::10 --port 9876 ', unit)
+        self.write_file.assert_any_call(
+            manila.MANILA_EXPORTER_SCRAPE_CONF,
+            (b"- job_name: manila-0\n"
+             b"  static_configs:\n"
+             b"    - targets: ['[fd00::10]:9876']\n"
+             b"      labels:\n"
+             b"        juju_unit: manila/0\n"),
+            perms=0o644)
+
+    def test_configure_metrics_exporter_disabled(self):
+        c = self._patch_exporter(0)
+        c.configure_metrics_exporter()
+        self.service_stop.assert_called_once_with('manila-exporter')
+        self.service.assert_called_once_with('disable', 'manila-exporter')
+        self.remove.assert_has_calls([
+            mock.call(manila.MANILA_EXPORTER_UNIT),
+            mock.call(manila.MANILA_EXPORTER_SCRAPE_CONF)])
+        # so that the hooks stop writing their metrics.
+        self.rmtree.assert_called_once_with(manila.MANILA_EXPORTER_DIR)
+        self.call.assert_has_calls([
+            mock.call(['setfacl', '-x', 'u:manila-exporter', path])
+            for path in ('/var/log/apache2',
+                         '/var/log/apache2/manila_access.log',
+                         '/var/log/apache2/manila_deflate.log')])
+        self.adduser.assert_not_called()
+        self.write_file.assert_not_called()
+        self.queue_service_action.assert_not_called()
+
     def test_manila_plugin_adapters__local(self):
         c = self._patch_config_and_charm({})
         self.patch_object(c, 'get_adapter')
@@ -0,0 +1,65 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import types
+import unittest
+
+import jinja2
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'src', 'templates',
+                         'mitaka')
+
+
+def _render(**options):
+    defaults = {
+        'service_listen_info': {'manila_api': {'public_port': 8776}},
+        'wsgi_worker_context': {'processes': 4},
+        'apache_buffered_logs': False,
+        'api_compression': False,
+        'api_preload': False,
+        'api_version_cache_ttl': 0,
+    }
+    defaults.update(options)
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES))
+    return env.get_template('manila-api.conf').render(
+        options=types.SimpleNamespace(**defaults))
+
+
+class TestManilaAPISite(unittest.TestCase):
+
+    def test_preload_disabled(self):
+        conf = _render()
+        self.assertIn('    WSGIScriptAlias / /usr/bin/manila-wsgi\n', conf)
+        self.assertNotIn('process-group=', conf)
+
+    def test_preload(self):
+        conf = _render(api_preload=True)
+        self.assertIn(
+            '    WSGIScriptAlias / /usr/bin/manila-wsgi '
+            'process-group=manila-api application-group=%{GLOBAL}\n', conf)
+        # the groups must match those the requests are served in.
+        self.assertIn('    WSGIProcessGroup manila-api\n', conf)
+        self.assertIn('    WSGIApplicationGroup %{GLOBAL}\n', conf)
+
+    def test_version_cache(self):
+        self.assertNotIn('CacheEnable', _render())
+        conf = _render(api_version_cache_ttl=30)
+        self.assertIn('    CacheDefaultExpire 30\n', conf)
+        self.assertIn('    <LocationMatch "^/(v[12]/?)?$">\n'
+                      '        CacheEnable socache\n', conf)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import configparser
+import os
+import types
+import unittest
+
+import jinja2
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'src', 'templates')
+
+
+def _identity_service(**kwargs):
+    defaults = {
+        'auth_protocol': 'https',
+        'auth_host': '10.0.0.20',
+        'auth_port': 35357,
+        'service_domain': 'service_domain',
+        'service_tenant': 'services',
+        'service_username': 'manila',
+        'service_password': 'secret',
+    }
+    defaults.update(kwargs)
+    return types.SimpleNamespace(**defaults)
+
+
+def _render(identity_service=None, **options):
+    # the parts/ sections come from the layers, not this charm.
+    loader = jinja2.ChoiceLoader([
+        jinja2.FileSystemLoader(os.path.join(TEMPLATES, 'rocky')),
+        jinja2.FunctionLoader(
+            lambda name: '' if name.startswith('parts/') else None),
+    ])
+    defaults = {
+        'user_config_flags': {},
+        'computed_backend_lines_manila_conf': [],
+        'region': 'RegionOne',
+        'service_client_timeout': 0,
+        'service_client_retries': 3,
+    }
+    defaults.update(options)
+    env = jinja2.Environment(loader=loader)
+    # keep the [DEFAULT] options out of the other sections.
+    parser = configparser.ConfigParser(interpolation=None, strict=False,
+                                       default_section='__none__')
+    parser.read_string(env.get_template('manila.conf').render(
+        options=types.SimpleNamespace(**defaults),
+        identity_service=identity_service or _identity_service()))
+    return parser
+
+
+class TestManilaConf(unittest.TestCase):
+
+    def test_service_clients(self):
+        conf = _render()
+        expected = {
+            'auth_type': 'password',
+            'auth_url': 'https://10.0.0.20:35357',
+            'project_domain_name': 'service_domain',
+            'user_domain_name': 'service_domain',
+            'project_name': 'services',
+            'username': 'manila',
+            'password': 'secret',
+            'region_name': 'RegionOne',
+            'endpoint_type': 'internalURL',
+        }
+        for section in ('nova', 'neutron', 'glance'):
+            self.assertEqual(dict(conf[section]), expected, section)
+        # no timeout unless it is configured.
+        expected['http_retries'] = '3'
+        self.assertEqual(dict(conf['cinder']), expected)
+
+    def test_service_client_timeout(self):
+        conf = _render(service_client_timeout=30, service_client_retries=5)
+        for section in ('nova', 'neutron', 'cinder', 'glance'):
+            self.assertEqual(conf.get(section, 'timeout'), '30', section)
+        self.assertEqual(conf.get('cinder', 'http_retries'), '5')
+        self.assertFalse(conf.has_option('nova', 'http_retries'))
+
+    def test_no_identity_service(self):
+        conf = _render(identity_service=types.SimpleNamespace(auth_host=None))
+        for section in ('nova', 'neutron', 'cinder', 'glance'):
+            self.assertFalse(conf.has_section(section), section)
+
+
+if __name__ == '__main__':
+    unittest.main()
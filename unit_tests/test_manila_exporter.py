@@ -0,0 +1,156 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+import manila_exporter
+
+
+def _line(status, usecs):
+    return ('10.0.0.1 - - [19/Oct/2026:12:00:00 +0000] '
+            '"GET /v2/shares HTTP/1.1" {} 12 "-" "client" {}\n'
+            .format(status, usecs))
+
+
+class TestManilaExporter(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _write(self, path, data, mode='w'):
+        path = os.path.join(self.tmp, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, mode) as f:
+            f.write(data)
+        return path
+
+    def test_access_log_stats(self):
+        path = self._write('access.log', _line(200, 5000))
+        stats = manila_exporter.AccessLogStats(path)
+        stats.update()
+        # existing requests aren't counted
+        self.assertEqual(stats.count, 0)
+        self._write('access.log', _line(200, 20000) + _line(503, 2000000) +
+                    '10.0.0.1 - - [partial', mode='a')
+        stats.update()
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.requests, {'200': 1, '503': 1})
+        self._write('access.log', ' line" 200 1 "-" "-" 1000\n', mode='a')
+        stats.update()
+        # the partial line is completed, but doesn't match.
+        self.assertEqual(stats.count, 2)
+        metrics = stats.metrics()
+        self.assertIn('manila_api_requests_total{code="503"} 1', metrics)
+        self.assertIn(
+            'manila_api_request_duration_seconds_bucket{le="0.025"} 1',
+            metrics)
+        self.assertIn(
+            'manila_api_request_duration_seconds_bucket{le="2.5"} 2',
+            metrics)
+        self.assertIn('manila_api_request_duration_seconds_count 2', metrics)
+
+    def test_access_log_rotated(self):
+        path = self._write('access.log', _line(200, 5000))
+        stats = manila_exporter.AccessLogStats(path)
+        stats.update()
+        os.rename(path, path + '.1')
+        self._write('access.log', _line(404, 5000))
+        stats.update()
+        self.assertEqual(stats.requests, {'404': 1})
+
+    def test_compression_log_stats(self):
+        path = self._write('deflate.log', '')
+        stats = manila_exporter.CompressionLogStats(path)
+        stats.update()
+        self._write('deflate.log', '20000 2500\n- -\n8000 1500\n',
+                    mode='a')
+        metrics = stats.metrics()
+        self.assertIn('manila_api_compressed_responses_total 2', metrics)
+        self.assertIn('manila_api_compression_input_bytes_total 28000',
+                      metrics)
+        self.assertIn('manila_api_compression_output_bytes_total 4000',
+                      metrics)
+
+    def test_service_metrics(self):
+        self._write('cgroup/apache2.service/memory.current', '1048576\n')
+        self._write('cgroup/apache2.service/cpu.stat',
+                    'usage_usec 2500000\nuser_usec 2000000\n')
+        metrics = manila_exporter.service_metrics(
+            ['apache2', 'manila-data'], os.path.join(self.tmp, 'cgroup'))
+        self.assertIn('manila_service_memory_bytes{service="apache2"} '
+                      '1048576', metrics)
+        self.assertIn('manila_service_cpu_seconds_total{service="apache2"} '
+                      '2.5', metrics)
+        self.assertFalse([m for m in metrics if 'manila-data' in m])
+
+    def test_wsgi_process_metrics(self):
+        self._write('proc/10/cmdline', b'(wsgi:manila-api)     \x00', 'wb')
+        self._write('proc/11/cmdline', b'(wsgi:manila-api)     \x00', 'wb')
+        self._write('proc/12/cmdline', b'/usr/sbin/apache2\x00-k', 'wb')
+        self._write('proc/self/cmdline', b'(wsgi:manila-api)', 'wb')
+        self.assertIn('manila_wsgi_processes 2',
+                      manila_exporter.wsgi_process_metrics(
+                          os.path.join(self.tmp, 'proc')))
+
+    def test_hook_metrics(self):
+        path = os.path.join(self.tmp, 'hook.json')
+        self.assertEqual(manila_exporter.hook_metrics(path), [])
+        self._write('hook.json', json.dumps(
+            {'hook': 'update-status', 'duration': 2.5, 'timestamp': 10.0}))
+        metrics = manila_exporter.hook_metrics(path)
+        self.assertIn('manila_charm_last_hook_duration_seconds'
+                      '{hook="update-status"} 2.5', metrics)
+        # written by charms that predate the suppressed writes counter.
+        self.assertIn('manila_charm_plugin_auth_writes_suppressed_total 0',
+                      metrics)
+        self._write('hook.json', json.dumps(
+            {'hook': 'update-status', 'duration': 2.5, 'timestamp': 10.0,
+             'plugin_auth_suppressed': 4}))
+        self.assertIn('manila_charm_plugin_auth_writes_suppressed_total 4',
+                      manila_exporter.hook_metrics(path))
+
+    def test_exporter_metrics(self):
+        exporter = manila_exporter.Exporter(
+            os.path.join(self.tmp, 'access.log'), ['apache2'],
+            os.path.join(self.tmp, 'hook.json'),
+            cgroup_root=os.path.join(self.tmp, 'cgroup'),
+            proc_root=self.tmp)
+        text = exporter.metrics()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('# TYPE manila_api_request_duration_seconds histogram',
+                      text)
+        self.assertIn('manila_wsgi_processes 0', text)
+
+    def test_serve_metrics(self):
+        exporter = manila_exporter.Exporter(
+            os.path.join(self.tmp, 'access.log'), ['apache2'],
+            os.path.join(self.tmp, 'hook.json'),
+            cgroup_root=os.path.join(self.tmp, 'cgroup'),
+            proc_root=self.tmp)
+        server = manila_exporter.ThreadingHTTPServer(
+            ('127.0.0.1', 0), manila_exporter.make_handler(exporter))
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+        with urllib.request.urlopen(url, timeout=10) as response:
+            self.assertIn(b'manila_wsgi_processes 0', response.read())
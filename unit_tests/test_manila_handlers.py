@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 from unittest import mock
 
 import reactive.manila_handlers as handlers
@@ -43,12 +44,14 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
                                    'amqp.available', ),
                 'config_rendered': ('db.synced', 'manila.config.rendered',),
                 'cluster_connected': ('ha.connected',),
+                'publish_api_capacity': ('cluster.connected',),
                 'configure_nrpe': ('config.rendered',)
             },
             'when_not': {
                 'register_endpoints': ('identity-service.available', ),
                 'maybe_do_syncdb': ('db.synced',),
-                'config_rendered': ('config.rendered',)
+                'config_rendered': ('config.rendered',),
+                'remove_nrpe_sudoers': ('nrpe-external-master.available',),
             },
             'when_any': {
                 'config_changed': ('config-changed',
@@ -60,6 +63,15 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
                 'configure_nrpe': (
                     'config.changed.nagios_context',
                     'config.changed.nagios_servicegroups',
+                    'config.changed.api-check-latency-warn',
+                    'config.changed.api-check-latency-crit',
+                    'config.changed.api-check-window',
+                    'config.changed.api-check-p95-warn',
+                    'config.changed.api-check-p95-crit',
+                    'config.changed.api-check-error-rate-warn',
+                    'config.changed.api-check-error-rate-crit',
+                    'config.changed.metrics-exporter-port',
+                    'config.changed.share-service-per-backend',
                     'endpoint.nrpe-external-master.changed',
                     'nrpe-external-master.available', )
             },
@@ -75,6 +87,9 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
 class TestRenderStuff(test_utils.PatchHelper):
 
     def _patch_provide_charm_instance(self):
+        # each test is a new hook, so drop the cached charm instance.
+        handlers._manila_charm = None
+        self.addCleanup(setattr, handlers, '_manila_charm', None)
         manila_charm = mock.MagicMock()
         self.patch('charms_openstack.charm.provide_charm_instance',
                    name='provide_charm_instance',
@@ -89,6 +104,11 @@ class TestRenderStuff(test_utils.PatchHelper):
         manila_charm.register_endpoints.assert_called_once_with('keystone')
         manila_charm.assess_status.assert_called_once_with()
 
+    def test_remove_nrpe_sudoers(self):
+        self.patch_object(handlers.manila, 'remove_nagios_sudoers')
+        handlers.remove_nrpe_sudoers()
+        self.remove_nagios_sudoers.assert_called_once_with()
+
     def test_maybe_do_syncdb(self):
         manila_charm = self._patch_provide_charm_instance()
         handlers.maybe_do_syncdb('shared_db')
@@ -97,6 +117,8 @@ class TestRenderStuff(test_utils.PatchHelper):
     def test_render_stuff(self):
         manila_charm = self._patch_provide_charm_instance()
         self.patch('charms.reactive.set_state', name='set_state')
+        self.patch('charms.reactive.is_state', name='is_state',
+                   return_value=True)
         manila_charm.get_state.side_effect = [False, True]
 
         tls = mock.MagicMock()
@@ -126,11 +148,24 @@ class TestRenderStuff(test_utils.PatchHelper):
         manila_charm.configure_tls.assert_called_once_with(
             certificates_interface=tls)
         manila_charm.register_endpoints.assert_called_once_with(keystone)
+        manila_charm.configure_http2.assert_called_once_with()
+        manila_charm.configure_compression.assert_called_once_with()
+        manila_charm.configure_version_cache.assert_called_once_with()
+        manila_charm.configure_data_mount_location.assert_called_once_with()
+        manila_charm.configure_profiler.assert_called_once_with()
+        manila_charm.configure_resource_controls.assert_called_once_with()
+        manila_charm.configure_share_instances.assert_called_once_with()
+        self.is_state.assert_called_once_with(
+            'nrpe-external-master.available')
+        manila_charm.render_nrpe_checks.assert_called_once_with()
 
     def test_render_stuff_no_tls_change(self):
         manila_charm = self._patch_provide_charm_instance()
         self.patch('charms.reactive.set_state', name='set_state')
+        self.patch('charms.reactive.is_state', name='is_state',
+                   return_value=True)
         manila_charm.get_state.side_effect = [True, True]
+        manila_charm.configure_share_instances.return_value = False
 
         tls = mock.MagicMock()
         manila_plugin = mock.MagicMock()
@@ -159,8 +194,170 @@ class TestRenderStuff(test_utils.PatchHelper):
         manila_charm.configure_tls.assert_called_once_with(
             certificates_interface=tls)
         manila_charm.register_endpoints.assert_not_called()
+        manila_charm.render_nrpe_checks.assert_not_called()
+
+    def test_update_status(self):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.share_services = ['manila-share@a', 'manila-share@b']
+        self.patch_object(handlers.os_utils, 'is_unit_paused_set',
+                          return_value=False)
+        self.patch_object(handlers.os_utils, '_ows_check_services_running',
+                          return_value=('blocked', 'not running'))
+        self.patch_object(handlers.ch_host, 'service_start')
+        handlers.update_status()
+        self._ows_check_services_running.assert_called_once_with(
+            services=['manila-share@a', 'manila-share@b'], ports=None)
+        self.service_start.assert_has_calls([
+            mock.call('manila-share@a'),
+            mock.call('manila-share@b')])
+
+    def test_charm_constructed_once_per_hook(self):
+        manila_charm = self._patch_provide_charm_instance()
+        self.provide_charm_instance.reset_mock()
+        self.patch('charms.reactive.set_state', name='set_state')
+        self.patch('charms.reactive.relations.endpoint_from_flag',
+                   name='endpoint_from_flag')
+        manila_charm.get_state.return_value = True
+        handlers.register_endpoints('keystone')
+        handlers.render_stuff('arg1')
+        handlers.cluster_connected('hacluster')
+        handlers.configure_nrpe()
+        self.provide_charm_instance.assert_called_once_with()
+
+    def test_charm_constructed_after_upgrade(self):
+        self._patch_provide_charm_instance()
+        self.provide_charm_instance.reset_mock()
+        self.patch_object(handlers.manila.ManilaCharm, 'upgrades', new=0)
+        handlers.register_endpoints('keystone')
+        handlers.register_endpoints('keystone')
+        self.provide_charm_instance.assert_called_once_with()
+        # the release class may have changed.
+        handlers.manila.ManilaCharm.upgrades = 1
+        handlers.register_endpoints('keystone')
+        handlers.register_endpoints('keystone')
+        self.assertEqual(self.provide_charm_instance.call_count, 2)
+
+    def test_status_assessed_once_per_hook(self):
+        manila_charm = self._patch_provide_charm_instance()
+        # run the real deferral, as ManilaCharm, on the mocked instance.
+        manila_charm.__class__ = handlers.manila.ManilaCharm
+        manila_charm.assess_status.side_effect = functools.partial(
+            handlers.manila.ManilaCharm.assess_status, manila_charm)
+        manila_charm._run_deferred_assess_status.side_effect = (
+            functools.partial(
+                handlers.manila.ManilaCharm._run_deferred_assess_status,
+                manila_charm))
+        self.patch_object(handlers.manila.ManilaCharm,
+                          '_assess_status_deferred', new=False)
+        callbacks = []
+        self.patch_object(handlers.manila.hookenv, 'atexit',
+                          side_effect=callbacks.append)
+        self.patch('charms_openstack.charm.OpenStackCharm.assess_status',
+                   name='base_assess_status')
+        self.patch('charms.reactive.set_state', name='set_state')
+        self.patch('charms.reactive.is_state', name='is_state')
+        self.patch('charms.reactive.relations.endpoint_from_flag',
+                   name='endpoint_from_flag')
+        manila_charm.get_state.return_value = True
+        handlers.register_endpoints('keystone')
+        handlers.render_stuff('arg1')
+        handlers.cluster_connected('hacluster')
+        self.assertEqual(manila_charm.assess_status.call_count, 3)
+        self.assertEqual(callbacks,
+                         [manila_charm._run_deferred_assess_status])
+        self.base_assess_status.assert_not_called()
+        for callback in reversed(callbacks):
+            callback()
+        self.base_assess_status.assert_called_once_with()
+
+    def test_replay_pending_restarts(self):
+        manila_charm = self._patch_provide_charm_instance()
+        pending = {'manila-data': 'restart'}
+        store = {handlers.manila.PENDING_RESTARTS_KEY: pending}
+        self.patch_object(handlers.unitdata, 'kv')
+        self.kv.return_value.get.side_effect = store.get
+        self.patch_object(handlers.os_utils, 'is_unit_paused_set',
+                          return_value=True)
+        self.patch_object(handlers.hookenv, 'atexit')
+        handlers._replay_pending_restarts()
+        self.atexit.assert_not_called()
+        self.is_unit_paused_set.return_value = False
+        handlers._replay_pending_restarts()
+        self.atexit.assert_called_once_with(handlers._run_pending_restarts)
+        self.atexit.reset_mock()
+        pending.clear()
+        handlers._replay_pending_restarts()
+        self.atexit.assert_not_called()
+        handlers._run_pending_restarts()
+        manila_charm.run_pending_restarts.assert_called_once_with()
+
+    def test_publish_api_capacity(self):
+        manila_charm = self._patch_provide_charm_instance()
+        handlers.publish_api_capacity('cluster')
+        manila_charm.publish_api_capacity.assert_called_once_with()
 
     def test_config_changed(self):
         self.patch_object(handlers, 'render_stuff')
         handlers.config_changed('hello', 'there')
         self.render_stuff.assert_called_once_with('hello', 'there')
+
+
+class TestShareToManilaPluginsAuth(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.keystone = mock.MagicMock()
+        self.keystone.service_username.return_value = 'user'
+        self.keystone.service_password.return_value = 'pass'
+        self.keystone.service_domain.return_value = 'domain'
+        self.keystone.service_protocol.return_value = 'http'
+        self.keystone.service_host.return_value = 'host'
+        self.keystone.service_port.return_value = '5000'
+        self.keystone.auth_protocol.return_value = 'http'
+        self.keystone.auth_host.return_value = 'host'
+        self.keystone.auth_port.return_value = '35357'
+        self.patch('charms.reactive.endpoint_from_flag',
+                   name='reactive_endpoint_from_flag',
+                   return_value=self.keystone)
+        self.manila_plugin = mock.MagicMock()
+        relation = mock.MagicMock()
+        relation.relation_id = 'manila-plugin:1'
+        self.manila_plugin.relations = [relation]
+        self.patch('charms.reactive.relations.endpoint_from_flag',
+                   name='endpoint_from_flag',
+                   side_effect=[self.manila_plugin, None] * 2)
+        self.store = {}
+        db = mock.MagicMock()
+        db.get.side_effect = lambda k, d=None: self.store.get(k, d)
+        db.set.side_effect = lambda k, v: self.store.__setitem__(k, v)
+        self.db = db
+        self.patch_object(handlers.unitdata, 'kv', return_value=db)
+
+    def test_publishes_once_when_unchanged(self):
+        handlers.share_to_manila_plugins_auth()
+        handlers.share_to_manila_plugins_auth()
+        self.manila_plugin.set_authentication_data.assert_called_once_with(
+            mock.ANY)
+        data = self.manila_plugin.set_authentication_data.call_args[0][0]
+        self.assertEqual(data['username'], 'user')
+        self.assertEqual(data['auth_url'], 'http://host:35357')
+        self.assertEqual(self.store[handlers.PLUGIN_AUTH_SUPPRESSED_KEY], 1)
+        # charms.reactive commits the hashes only if the hook succeeds.
+        self.db.flush.assert_not_called()
+
+    def test_record_hook_duration(self):
+        self.store[handlers.PLUGIN_AUTH_SUPPRESSED_KEY] = 5
+        self.patch_object(handlers.hookenv, 'hook_name',
+                          return_value='update-status')
+        self.patch_object(handlers.manila, 'record_hook_duration')
+        handlers._record_hook_duration()
+        self.record_hook_duration.assert_called_once_with(
+            'update-status', mock.ANY, 5)
+
+    def test_publishes_again_on_change(self):
+        handlers.share_to_manila_plugins_auth()
+        self.keystone.service_password.return_value = 'new-pass'
+        handlers.share_to_manila_plugins_auth()
+        self.assertEqual(
+            self.manila_plugin.set_authentication_data.call_count, 2)
+        self.assertNotIn(handlers.PLUGIN_AUTH_SUPPRESSED_KEY, self.store)
@@ -0,0 +1,80 @@
+# Copyright 2026 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import types
+import unittest
+
+import jinja2
+
+TEMPLATES = os.path.join(os.path.dirname(__file__), '..', 'src', 'templates')
+
+
+def _render(release, template, **options):
+    # the parts/ sections come from the layers, not this charm.
+    loader = jinja2.ChoiceLoader([
+        jinja2.FileSystemLoader(os.path.join(TEMPLATES, release)),
+        jinja2.FunctionLoader(
+            lambda name: '' if name.startswith('parts/') else None),
+    ])
+    defaults = {
+        'user_config_flags': {},
+        'computed_backend_lines_manila_conf': [],
+    }
+    defaults.update(options)
+    env = jinja2.Environment(loader=loader)
+    return env.get_template(template).render(
+        options=types.SimpleNamespace(**defaults),
+        identity_service=types.SimpleNamespace())
+
+
+class TestProfilerTemplates(unittest.TestCase):
+
+    def test_profiler_section(self):
+        for release in ('pike', 'queens', 'rocky'):
+            conf = _render(
+                release, 'manila.conf', profiler=True,
+                profiler_hmac_key='hmac',
+                computed_profiler_connection_string='redis://127.0.0.1:6379')
+            self.assertIn('[profiler]\n'
+                          'enabled = True\n'
+                          'hmac_keys = hmac\n'
+                          'connection_string = redis://127.0.0.1:6379\n'
+                          'trace_sqlalchemy = True\n', conf, release)
+            self.assertNotIn('[profiler]',
+                             _render(release, 'manila.conf', profiler=False))
+
+    def test_api_paste_pipeline(self):
+        conf = _render('pike', 'api-paste.ini', profiler=True)
+        self.assertIn('keystone = cors faultwrap ssl sizelimit osprofiler '
+                      'authtoken keystonecontext apiv2\n', conf)
+        self.assertIn('[filter:osprofiler]\n', conf)
+        conf = _render('pike', 'api-paste.ini', profiler=False)
+        self.assertIn('keystone = cors faultwrap ssl sizelimit '
+                      'authtoken keystonecontext apiv2\n', conf)
+        self.assertNotIn('osprofiler', conf)
+        # before pike there is no [profiler] section to configure it.
+        self.assertNotIn('osprofiler',
+                         _render('mitaka', 'api-paste.ini', profiler=True))
+        # the filter is always in the pipeline from caracal, and does
+        # nothing unless [profiler] enables it.
+        for profiler in (False, True):
+            conf = _render('caracal', 'api-paste.ini', profiler=profiler)
+            self.assertIn('keystone = cors faultwrap http_proxy_to_wsgi '
+                          'sizelimit osprofiler authtoken keystonecontext '
+                          'apiv2\n', conf)
+
+
+if __name__ == '__main__':
+    unittest.main()